@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+End to end benchmark of the scraper against the local FTS stand-in (benchmarks.server). Times getting locations,
+setting up FTS (plans and the other stages in FTS.timings), generating the flows resources for one country and the
+full country loop (without uploading to HDX) for each concurrency given. Results are written as JSON so that runs can
+be compared.
+
+    python -m benchmarks.endtoend --latency 0.05 --scale 10 --concurrency 1,4 --rate-limit none --output results.json
+
+'''
+import argparse
+import json
+import logging
+import time
+from datetime import datetime
+from os.path import join
+
+from hdx import hdx_locations
+from hdx.data.dataset import Dataset
+from hdx.data.vocabulary import Vocabulary
+from hdx.hdx_configuration import Configuration
+from hdx.location.country import Country
+from hdx.utilities.dateparse import parse_date
+from hdx.utilities.downloader import Download
+from hdx.utilities.loader import load_yaml
+from hdx.utilities.path import temp_dir
+
+from benchmarks.server import StandInServer
+from fts.download import FTSDownload
+from fts.locations import Locations
+from fts.main import FTS
+
+logger = logging.getLogger(__name__)
+
+tags = ['hxl', 'financial tracking service - fts', 'aid funding', 'epidemics and outbreaks', 'covid-19']
+
+
+def setup_configuration(url):
+    project_config = load_yaml(join('config', 'project_configuration.yml'))
+    project_config['base_url'] = f'{url}/v'
+    project_config['test_url'] = f'{url}/'
+    Configuration._create(hdx_read_only=True, user_agent='benchmark', project_config_dict=project_config)
+    Country.countriesdata(False)
+    Vocabulary._approved_vocabulary = {'tags': [{'name': tag} for tag in tags], 'id': 'benchmark', 'name': 'approved'}
+    return Configuration.read()
+
+
+def parse_rate_limit(text):
+    if not text or text.lower() == 'none':
+        return None
+    calls, period, *max_calls = text.split('/')
+    rate_limit = {'calls': int(calls), 'period': float(period)}
+    if max_calls:
+        rate_limit['max_calls'] = int(max_calls[0])
+    return rate_limit
+
+
+def time_stage(timings, stage, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings[stage] = time.perf_counter() - start
+    return result
+
+
+def run(configuration, server, concurrency, rate_limit, today, start_year, flows_year):
+    timings = dict()
+    requests = server.requests
+    start = time.perf_counter()
+    with temp_dir('FTS-BENCHMARK') as folder:
+        with Download(user_agent='benchmark') as downloader:
+            ftsdownloader = FTSDownload(configuration, downloader, rate_limit=rate_limit, concurrency=concurrency,
+                                        downloader_factory=lambda: Download(user_agent='benchmark'), retry_backoff=0.1)
+            locations = time_stage(timings, 'locations', Locations, ftsdownloader)
+            hdx_locations.Locations.set_validlocations([{'name': country['iso3'].lower(), 'title': country['name']}
+                                                        for country in locations.countries])
+            fts = time_stage(timings, 'fts_init', FTS, ftsdownloader, locations, today, configuration['notes'],
+                             start_year=start_year)
+            country = locations.countries[0]
+            time_stage(timings, 'flows', fts.flows.generate_resources, folder, Dataset({'name': 'benchmark'}),
+                       flows_year, country)
+
+            def country_loop():
+                for country in locations.countries:
+                    fts.generate_dataset_and_showcase(folder, country)
+
+            time_stage(timings, 'countries', country_loop)
+            ftsdownloader.close()
+    timings['total'] = time.perf_counter() - start
+    return {'concurrency': concurrency, 'rate_limit': rate_limit, 'timings': timings, 'fts_stages': fts.timings,
+            'requests': server.requests - requests, 'metrics': ftsdownloader.metrics.get_report()['requests']}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', default=0.05, type=float, help='Seconds the stand-in delays each response')
+    parser.add_argument('--scale', default=1, type=int, help='Multiply the flows in each page by this')
+    parser.add_argument('--server-rate-limit', default=None, help='Rate limit of the stand-in as calls/period')
+    parser.add_argument('--rate-limit', default='1/1',
+                        help='Rate limit of the scraper as calls/period, calls/period/max_calls to adapt or none')
+    parser.add_argument('--concurrency', default='1', help='Comma separated concurrencies to run')
+    parser.add_argument('--today', default='2020-12-31', help='Date to use for today')
+    parser.add_argument('--start-year', default=2019, type=int, help='First year of plans')
+    parser.add_argument('--flows-year', default='2020', help='Year of flows to generate for the flows stage')
+    parser.add_argument('--output', default=None, help='Write results as JSON to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    rate_limit = parse_rate_limit(args.rate_limit)
+    today = parse_date(args.today)
+    results = {'started': datetime.now().isoformat(), 'latency': args.latency, 'scale': args.scale,
+               'server_rate_limit': args.server_rate_limit, 'runs': list()}
+    with StandInServer(latency=args.latency, rate_limit=parse_rate_limit(args.server_rate_limit),
+                       scale=args.scale) as server:
+        configuration = setup_configuration(server.url)
+        for concurrency in args.concurrency.split(','):
+            result = run(configuration, server, int(concurrency), rate_limit, today, args.start_year,
+                         args.flows_year)
+            results['runs'].append(result)
+            timings = ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in result['timings'].items())
+            print(f'concurrency {concurrency}: {result["requests"]} requests, {timings}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Micro-benchmark of flattening flows into rows using the flows in the test fixtures, comparing Flows.flatten_flow
+with the implementation before column mappings were memoised (BaselineFlows).
+
+    python -m benchmarks.flatten
+
+'''
+import json
+import logging
+import time
+from glob import glob
+from os.path import join
+
+from hdx.location.country import Country
+from hdx.utilities.dictandlist import dict_of_lists_add
+from hdx.utilities.text import multiple_replace
+
+from fts.flows import Flows, srcdestmap
+from fts.helpers import country_all_columns_to_keep, rename_columns
+from fts.locations import Locations
+
+logger = logging.getLogger(__name__)
+
+fixtures = join('tests', 'fixtures', 'input')
+
+
+class FixtureDownload:
+    @staticmethod
+    def download(partial_url):
+        with open(join(fixtures, '1-public-location.json')) as f:
+            return json.load(f)['data']
+
+
+class BaselineFlows(Flows):
+    '''
+    Flattening as it was before column mappings were memoised: every key of every object is renamed and has its rule
+    worked out for every flow.
+    '''
+    def flatten_objects(self, objs, shortened, newrow):
+        objinfo_by_type = dict()
+        plan_id = None
+        destPlanId = None
+        for obj in objs:
+            objtype = obj['type']
+            objinfo = objinfo_by_type.get(objtype, dict())
+            for key in obj:
+                if objtype == 'Plan' and key == 'id':
+                    plan_id = obj[key]
+                    dict_of_lists_add(objinfo, key, plan_id)
+                    if shortened == 'dest':
+                        destPlanId = plan_id
+                if key not in ['type', 'behavior', 'id']:
+                    value = obj[key]
+                    if isinstance(value, list):
+                        for element in value:
+                            dict_of_lists_add(objinfo, key, element)
+                    else:
+                        dict_of_lists_add(objinfo, key, value)
+            objinfo_by_type[objtype] = objinfo
+        for objtype in objinfo_by_type:
+            prefix = '%s%s' % (shortened, objtype)
+            for key in objinfo_by_type[objtype]:
+                keyname = '%s%s' % (prefix, key.capitalize())
+                values = objinfo_by_type[objtype][key]
+                replacements = {'OrganizationOrganization': 'Organization', 'Name': '', 'types': 'Types',
+                                'code': 'Code'}
+                keyname = multiple_replace(keyname, replacements)
+                if 'UsageYear' in keyname:
+                    values = sorted(values)
+                    newrow['%sStart' % keyname] = values[0]
+                    outputstr = values[-1]
+                    keyname = '%sEnd' % keyname
+                elif any(x in keyname for x in ['Cluster', 'Location', 'OrganizationTypes']):
+                    if keyname[-1] != 's':
+                        keyname = '%ss' % keyname
+                    if 'Location' in keyname:
+                        iso3s = list()
+                        for country in values:
+                            iso3 = self.locations.get_countryiso_from_name(country)
+                            if iso3:
+                                iso3s.append(iso3)
+                        values = iso3s
+                    outputstr = ','.join(sorted(values))
+                else:
+                    if len(values) > 1:
+                        outputstr = 'Multiple'
+                        logger.error(f'Multiple used instead of {values} for {keyname} in {plan_id} ({shortened})')
+                    else:
+                        outputstr = values[0]
+                if keyname in country_all_columns_to_keep:
+                    newrow[keyname] = outputstr
+        return destPlanId
+
+    def flatten_flow(self, row):
+        newrow = dict()
+        destPlanId = None
+        for key in row:
+            if key == 'reportDetails':
+                continue
+            value = row[key]
+            shortened = srcdestmap.get(key)
+            if shortened:
+                newdestPlanId = self.flatten_objects(value, shortened, newrow)
+                if newdestPlanId:
+                    destPlanId = int(newdestPlanId)
+                continue
+            if key == 'keywords':
+                if value:
+                    newrow[key] = ','.join(value)
+                else:
+                    newrow[key] = ''
+                continue
+            if key in ['date', 'firstReportedDate', 'decisionDate', 'createdAt', 'updatedAt']:
+                if value:
+                    newrow[key] = value[:10]
+                else:
+                    newrow[key] = ''
+                continue
+            renamed_column = rename_columns.get(key)
+            if renamed_column:
+                newrow[renamed_column] = value
+                continue
+            if key in country_all_columns_to_keep:
+                newrow[key] = value
+        if 'originalAmount' not in newrow:
+            newrow['originalAmount'] = ''
+        if 'originalCurrency' not in newrow:
+            newrow['originalCurrency'] = ''
+        if 'refCode' not in newrow:
+            newrow['refCode'] = ''
+        newrow['destPlanCode'] = self.planidcodemapping.get(destPlanId, '')
+        return newrow
+
+
+def time_flatten(flowsgenerator, flows, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for flow in flows:
+            flowsgenerator.flatten_flow(flow)
+    return len(flows) * repeats / (time.perf_counter() - start)
+
+
+def main(repeats=200):
+    logging.disable(logging.CRITICAL)
+    Country.countriesdata(False)
+    flows = list()
+    for path in sorted(glob(join(fixtures, 'custom-search-locationid-*.json'))):
+        with open(path) as f:
+            flows.extend(json.load(f)['data']['flows'])
+    locations = Locations(FixtureDownload())
+    baseline = time_flatten(BaselineFlows(None, locations, dict()), flows, repeats)
+    current = time_flatten(Flows(None, locations, dict()), flows, repeats)
+    print(f'{len(flows) * repeats} rows each')
+    print(f'Baseline: {baseline:.0f} rows per second')
+    print(f'Current: {current:.0f} rows per second ({current / baseline:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
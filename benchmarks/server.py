@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Local stand-in for the FTS API serving the recorded responses in the test fixtures so that the scraper can be run
+and timed without calling api.hpc.tools. Requests are mapped to fixture files the same way FTSDownload names test
+files. nextLink urls are rewritten to point back at the stand-in. Optionally, every request is delayed by latency
+seconds, requests over the rate limit get a 429 (with a Retry-After if given) and the flows in each custom search
+page are multiplied by scale (with new ids) to give synthetic volume.
+
+    python -m benchmarks.server --port 8000 --latency 0.05 --scale 10
+
+'''
+import argparse
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import basename, exists, join
+from urllib.parse import unquote, urlsplit
+
+from fts.download import FTSDownload
+from fts.ratelimiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+fixtures = join('tests', 'fixtures', 'input')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def get_fixture(self):
+        split = urlsplit(unquote(self.path))
+        candidates = list()
+        if split.path.endswith('.json'):
+            candidates.append(basename(split.path))
+        partial_url = split.path.lstrip('/')
+        if partial_url.startswith('v'):
+            partial_url = partial_url[1:]
+        if split.query:
+            partial_url = f'{partial_url}?{split.query}'
+        candidates.append(FTSDownload.get_testfile_path(partial_url))
+        candidates.append(FTSDownload.get_testfile_path(None, unquote(self.path)))
+        for candidate in candidates:
+            path = join(self.server.folder, candidate)
+            if exists(path):
+                return path
+        return None
+
+    def send_json(self, code, body, headers=None):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        for header, value in (headers or dict()).items():
+            self.send_header(header, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.count()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.ratelimiter and not self.server.ratelimiter.try_acquire():
+            retry_after = {'Retry-After': str(self.server.retry_after)} if self.server.retry_after else None
+            self.send_json(429, {'status': 'error', 'message': 'Too many requests'}, retry_after)
+            return
+        path = self.get_fixture()
+        if path is None:
+            self.send_json(404, {'status': 'error', 'message': f'No fixture for {self.path}'})
+            return
+        with open(path) as f:
+            body = json.load(f)
+        meta = body.get('meta')
+        if meta and meta.get('nextLink'):
+            meta['nextLink'] = f'{self.server.url}/{basename(urlsplit(meta["nextLink"]).path)}'
+        data = body.get('data')
+        if self.server.scale > 1 and isinstance(data, dict) and 'flows' in data:
+            flows = list()
+            for i in range(self.server.scale):
+                for flow in data['flows']:
+                    flow = dict(flow)
+                    flow['id'] = str(int(flow['id']) * self.server.scale + i)
+                    flows.append(flow)
+            data['flows'] = flows
+        self.send_json(200, body)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, folder=fixtures, latency=0, rate_limit=None, scale=1, retry_after=None):
+        super().__init__(('127.0.0.1', port), StandInHandler)
+        self.folder = folder
+        self.latency = latency
+        if rate_limit:
+            self.ratelimiter = TokenBucket(rate_limit['calls'], rate_limit['period'])
+        else:
+            self.ratelimiter = None
+        self.scale = scale
+        self.retry_after = retry_after
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.thread = None
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', default=8000, type=int, help='Port to listen on')
+    parser.add_argument('--latency', default=0, type=float, help='Seconds to delay each response')
+    parser.add_argument('--rate-limit', default=None, help='Requests allowed per period in the form calls/period')
+    parser.add_argument('--scale', default=1, type=int, help='Multiply the flows in each page by this')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    rate_limit = None
+    if args.rate_limit:
+        calls, period = args.rate_limit.split('/')
+        rate_limit = {'calls': int(calls), 'period': float(period)}
+    server = StandInServer(args.port, latency=args.latency, rate_limit=rate_limit, scale=args.scale)
+    logger.info(f'Serving FTS stand-in at {server.url}/v')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
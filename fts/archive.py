@@ -0,0 +1,58 @@
+import logging
+import sqlite3
+import threading
+import zlib
+from os import listdir
+from os.path import join
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseArchive:
+    '''
+    Recording of FTS API responses in one SQLite file for replaying runs. Bodies are held zlib compressed and keyed
+    by the same normalised url as test files (see FTSDownload.get_cache_key) so they can be looked up directly.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.reopen()
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB)')
+        self.connection.commit()
+        self.recorded = 0
+        self.replayed = 0
+
+    def reopen(self):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+
+    def get(self, key):
+        with self.lock:
+            result = self.connection.execute('SELECT body FROM responses WHERE key=?', (key,)).fetchone()
+            if result is None:
+                return None
+            self.replayed += 1
+        return zlib.decompress(result[0])
+
+    def set(self, key, body):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?)', (key, zlib.compress(body, 9)))
+            self.connection.commit()
+            self.recorded += 1
+
+    def import_folder(self, folder):
+        '''
+        Add the JSON files in a test folder, keyed by file name.
+        '''
+        count = 0
+        for filename in sorted(listdir(folder)):
+            if not filename.endswith('.json'):
+                continue
+            with open(join(folder, filename), 'rb') as f:
+                self.set(filename, f.read())
+            count += 1
+        logger.info(f'Imported {count} responses from {folder}')
+        return count
+
+    def close(self):
+        logger.info(f'Archive recorded: {self.recorded}, replayed: {self.replayed}')
+        self.connection.close()
@@ -0,0 +1,119 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    '''
+    Persistent cache of FTS API response bodies held in an SQLite database. Time to live is looked up from a list of
+    rules, each with a regular expression pattern to match against the url. A rule either has a fixed ttl or, if the
+    pattern has a group named year, closed_year and current_year ttls (in seconds). Urls matching no rule are not
+    cached. Once the total size of cached bodies goes over max_size, the least recently used are evicted.
+    '''
+    def __init__(self, path, ttls, max_size=None, today=None):
+        self.rules = list()
+        for rule in ttls:
+            self.rules.append((re.compile(rule['pattern']), rule))
+        self.max_size = max_size
+        if today is None:
+            today = datetime.now()
+        self.current_year = today.year
+        self.path = path
+        self.reopen()
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, etag TEXT, '
+                                'lastmodified TEXT, expires REAL, accessed REAL, size INTEGER)')
+        self.connection.commit()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def reopen(self):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+
+    def get_ttl(self, url):
+        for pattern, rule in self.rules:
+            match = pattern.search(url)
+            if not match:
+                continue
+            ttl = rule.get('ttl')
+            if ttl is not None:
+                return ttl
+            year = match.groupdict().get('year')
+            if year is not None and int(year) < self.current_year:
+                return rule['closed_year']
+            return rule['current_year']
+        return None
+
+    def get(self, key):
+        '''
+        Get cached entry for key. Returns None if there is no entry, otherwise a dictionary with the body, whether it
+        is still fresh and any headers needed to revalidate it.
+        '''
+        with self.lock:
+            result = self.connection.execute('SELECT body, etag, lastmodified, expires FROM responses WHERE key=?',
+                                             (key,)).fetchone()
+            if result is None:
+                self.misses += 1
+                return None
+            body, etag, lastmodified, expires = result
+            now = time.time()
+            fresh = now < expires
+            if fresh:
+                self.hits += 1
+                self.connection.execute('UPDATE responses SET accessed=? WHERE key=?', (now, key))
+                self.connection.commit()
+            elif not etag and not lastmodified:
+                self.misses += 1
+                return None
+        validators = dict()
+        if etag:
+            validators['If-None-Match'] = etag
+        if lastmodified:
+            validators['If-Modified-Since'] = lastmodified
+        return {'body': body, 'fresh': fresh, 'validators': validators}
+
+    def refresh(self, key, url):
+        ttl = self.get_ttl(url)
+        if ttl is None:
+            return
+        now = time.time()
+        with self.lock:
+            self.revalidated += 1
+            self.connection.execute('UPDATE responses SET expires=?, accessed=? WHERE key=?', (now + ttl, now, key))
+            self.connection.commit()
+
+    def set(self, key, url, body, etag=None, lastmodified=None):
+        ttl = self.get_ttl(url)
+        if ttl is None:
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (key, body, etag, lastmodified, now + ttl, now, len(body)))
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        if not self.max_size:
+            return
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_size:
+            return
+        keys = list()
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            if total <= self.max_size:
+                break
+            keys.append((key,))
+            total -= size
+        self.connection.executemany('DELETE FROM responses WHERE key=?', keys)
+        logger.info(f'Evicted {len(keys)} responses from cache')
+
+    def close(self):
+        logger.info(f'Cache hits: {self.hits}, revalidated: {self.revalidated}, misses: {self.misses}')
+        self.connection.close()
@@ -0,0 +1,133 @@
+import logging
+from datetime import date
+from os import makedirs
+from os.path import join
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+# Column types: string, name (dictionary encoded string), list (of strings), int, float and date
+schemas = {
+    'flows': [('date', 'date'), ('budgetYear', 'int'), ('description', 'string'), ('amountUSD', 'float'),
+              ('srcOrganization', 'name'), ('srcOrganizationTypes', 'list'), ('srcLocations', 'list'),
+              ('srcUsageYearStart', 'int'), ('srcUsageYearEnd', 'int'), ('destPlan', 'name'),
+              ('destPlanCode', 'name'), ('destPlanId', 'int'), ('destOrganization', 'name'),
+              ('destOrganizationTypes', 'list'), ('destGlobalClusters', 'list'), ('destLocations', 'list'),
+              ('destProject', 'name'), ('destProjectCode', 'string'), ('destEmergency', 'name'),
+              ('destUsageYearStart', 'int'), ('destUsageYearEnd', 'int'), ('contributionType', 'name'),
+              ('flowType', 'name'), ('method', 'name'), ('boundary', 'name'), ('onBoundary', 'name'),
+              ('status', 'name'), ('firstReportedDate', 'date'), ('decisionDate', 'date'), ('keywords', 'list'),
+              ('originalAmount', 'float'), ('originalCurrency', 'name'), ('exchangeRate', 'float'), ('id', 'int'),
+              ('refCode', 'string'), ('createdAt', 'date'), ('updatedAt', 'date')],
+    'requirements_funding': [('countryCode', 'name'), ('id', 'int'), ('name', 'name'), ('code', 'name'),
+                             ('typeId', 'int'), ('typeName', 'name'), ('startDate', 'date'), ('endDate', 'date'),
+                             ('year', 'int'), ('requirements', 'float'), ('funding', 'float'),
+                             ('percentFunded', 'int')],
+    'cluster': [('countryCode', 'name'), ('id', 'int'), ('name', 'name'), ('code', 'name'), ('startDate', 'date'),
+                ('endDate', 'date'), ('year', 'int'), ('clusterCode', 'string'), ('cluster', 'name'),
+                ('requirements', 'float'), ('funding', 'float'), ('percentFunded', 'int')],
+    'covid': [('countryCode', 'name'), ('id', 'int'), ('name', 'name'), ('code', 'name'), ('typeId', 'int'),
+              ('typeName', 'name'), ('startDate', 'date'), ('endDate', 'date'), ('year', 'int'),
+              ('requirements', 'float'), ('funding', 'float'), ('covidFunding', 'float'),
+              ('covidPercentageOfFunding', 'int')]
+}
+schemas['globalcluster'] = schemas['cluster']
+partition_columns = {'countryCode', 'year'}
+
+
+def to_string(value):
+    return str(value)
+
+
+def to_list(value):
+    return list(value)
+
+
+def to_date(value):
+    return date.fromisoformat(value[:10])
+
+
+def to_number(converter):
+    # Single value columns hold Multiple when a flow has more than one value (see Flows.flatten_objects)
+    def convert(value):
+        try:
+            return converter(value)
+        except ValueError:
+            return None
+    return convert
+
+
+converters = {'string': to_string, 'name': to_string, 'list': to_list, 'int': to_number(int),
+              'float': to_number(float), 'date': to_date}
+
+
+class ColumnarExport:
+    '''
+    Parquet export of the flows and requirements and funding rows written alongside the CSVs. Each table is
+    partitioned by country and year into folder/table/countryCode=<iso3>/year=<year>/part-0.parquet so that all
+    countries can be read as one dataset. Columns are typed, list columns are kept as lists and organisation, plan and
+    other repeated names are dictionary encoded. Needs pyarrow.
+    '''
+    def __init__(self, folder):
+        if pyarrow is None:
+            raise ImportError('pyarrow must be installed to export Parquet')
+        self.folder = folder
+        self.partitions = dict()
+
+    def add(self, table, countryiso, year, row):
+        '''
+        Add row (a dictionary or a sequence in the order of the table's schema) to the partition for country and year.
+        '''
+        key = table, countryiso, int(year)
+        columns = self.partitions.get(key)
+        if columns is None:
+            columns = [list() for _ in schemas[table]]
+            self.partitions[key] = columns
+        if isinstance(row, dict):
+            row = [row.get(column) for column, _ in schemas[table]]
+        for values, value in zip(columns, row):
+            values.append(value)
+
+    def add_rows(self, table, countryiso, rows, yearcolumn='year'):
+        index = [column for column, _ in schemas[table]].index(yearcolumn)
+        for row in rows:
+            if isinstance(row, dict):
+                year = row[yearcolumn]
+            else:
+                year = row[index]
+            self.add(table, countryiso, year, row)
+
+    @staticmethod
+    def get_array(kind, values):
+        converter = converters[kind]
+        values = [None if value is None or value == '' else converter(value) for value in values]
+        if kind == 'name':
+            return pyarrow.array(values, type=pyarrow.string()).dictionary_encode()
+        if kind == 'list':
+            return pyarrow.array(values, type=pyarrow.list_(pyarrow.string()))
+        types = {'string': pyarrow.string(), 'int': pyarrow.int64(), 'float': pyarrow.float64(),
+                 'date': pyarrow.date32()}
+        return pyarrow.array(values, type=types[kind])
+
+    def write(self, table, countryiso):
+        '''
+        Write out and forget all partitions of table for country.
+        '''
+        for key in sorted(key for key in self.partitions if key[:2] == (table, countryiso)):
+            columns = self.partitions.pop(key)
+            names = list()
+            arrays = list()
+            for (column, kind), values in zip(schemas[table], columns):
+                if column in partition_columns:
+                    continue
+                names.append(column)
+                arrays.append(self.get_array(kind, values))
+            folder = join(self.folder, table, f'countryCode={countryiso}', f'year={key[2]}')
+            makedirs(folder, exist_ok=True)
+            pyarrow.parquet.write_table(pyarrow.Table.from_arrays(arrays, names=names), join(folder, 'part-0.parquet'))
+            logger.info(f'Exported {len(columns[0])} {table} rows for {countryiso} in {key[2]} to Parquet')
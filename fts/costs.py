@@ -0,0 +1,72 @@
+import json
+import logging
+from os.path import exists
+
+logger = logging.getLogger(__name__)
+
+
+class CountryCosts:
+    '''
+    History of what each country has cost to generate (wall time in seconds and FTS requests made) kept in a JSON file
+    and smoothed across runs. Used to start the most expensive countries first and to balance shards. Countries with no
+    history are estimated from their number of plans.
+    '''
+    def __init__(self, path=None, smoothing=0.5):
+        self.path = path
+        self.smoothing = smoothing
+        self.costs = dict()
+        if path and exists(path):
+            with open(path) as f:
+                self.costs = json.load(f)
+
+    def update(self, countries):
+        '''
+        Update from the per country times of a run (RunMetrics.countries).
+        '''
+        for countryiso, times in countries.items():
+            cost = {'seconds': times['seconds'], 'requests': times.get('requests', 0)}
+            previous = self.costs.get(countryiso)
+            if previous is not None:
+                cost = {name: previous.get(name, value) * self.smoothing + value * (1 - self.smoothing)
+                        for name, value in cost.items()}
+            self.costs[countryiso] = cost
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path, 'w') as f:
+            json.dump(self.costs, f, indent=2, sort_keys=True)
+
+    def get_seconds(self, countries, plan_counts=None, key='iso3'):
+        '''
+        Get the expected seconds for each country, estimating those without history from the seconds per plan of
+        those with history or failing that the average.
+        '''
+        if plan_counts is None:
+            plan_counts = dict()
+        seconds = dict()
+        unknown = list()
+        for country in countries:
+            countryiso = country[key]
+            cost = self.costs.get(countryiso)
+            if cost is None:
+                unknown.append(countryiso)
+            else:
+                seconds[countryiso] = cost['seconds']
+        if unknown:
+            known = list(seconds.values())
+            average = sum(known) / len(known) if known else 1
+            plans = sum(plan_counts.get(countryiso, 0) for countryiso in seconds)
+            for countryiso in unknown:
+                if plans and countryiso in plan_counts:
+                    seconds[countryiso] = sum(known) / plans * plan_counts[countryiso]
+                else:
+                    seconds[countryiso] = average
+        return seconds
+
+    def order(self, countries, plan_counts=None, key='iso3'):
+        '''
+        Order countries from the most to the least expensive so that large countries do not hold up the end of a run.
+        '''
+        seconds = self.get_seconds(countries, plan_counts, key)
+        return sorted(countries, key=lambda country: (-seconds[country[key]], country[key]))
@@ -0,0 +1,80 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class StageGraph:
+    '''
+    Runs stages once the stages they require have finished, with up to workers stages at the same time, timing each
+    one. With one worker, stages run on the calling thread in the order they were added. The critical path is the
+    chain of dependent stages taking longest, which is what limits the total time however many workers there are.
+    '''
+    def __init__(self):
+        self.stages = dict()
+        self.results = dict()
+        self.times = dict()
+
+    def add(self, name, function, requires=()):
+        for required in requires:
+            if required not in self.stages:
+                raise ValueError(f'Stage {name} requires {required} which has not been added')
+        self.stages[name] = function, tuple(requires)
+
+    def run_stage(self, name, start):
+        function, _ = self.stages[name]
+        begin = time.perf_counter() - start
+        self.results[name] = function()
+        self.times[name] = begin, time.perf_counter() - start
+
+    def run(self, workers=1):
+        start = time.perf_counter()
+        if workers < 2:
+            for name in self.stages:
+                self.run_stage(name, start)
+            return self.results
+        remaining = list(self.stages)
+        done = set()
+        running = dict()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while remaining or running:
+                for name in list(remaining):
+                    if all(required in done for required in self.stages[name][1]):
+                        remaining.remove(name)
+                        running[executor.submit(self.run_stage, name, start)] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    future.result()
+                    done.add(name)
+        return self.results
+
+    def get_critical_path(self):
+        '''
+        Get the names of the stages on the critical path and its total seconds.
+        '''
+        finishes = dict()
+        previous = dict()
+        for name, (_, requires) in self.stages.items():
+            begin, end = self.times[name]
+            before = max(requires, key=lambda required: finishes[required], default=None)
+            finishes[name] = end - begin + (finishes[before] if before else 0)
+            previous[name] = before
+        if not finishes:
+            return list(), 0
+        name = max(finishes, key=finishes.get)
+        total = finishes[name]
+        path = list()
+        while name:
+            path.append(name)
+            name = previous[name]
+        return path[::-1], total
+
+    def get_report(self):
+        stages = dict()
+        for name, (_, requires) in self.stages.items():
+            begin, end = self.times[name]
+            stages[name] = {'start': begin, 'end': end, 'seconds': end - begin, 'requires': list(requires)}
+        path, seconds = self.get_critical_path()
+        return {'stages': stages, 'critical_path': path, 'critical_path_seconds': seconds}
@@ -1,30 +1,73 @@
-import copy
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from json import loads
 from os.path import join, basename
 from urllib.parse import urlsplit
 
+import ijson
+from hdx.utilities.downloader import DownloadError
 from hdx.utilities.saver import save_json
+from ijson.common import ObjectBuilder
 from slugify import slugify
 
+from fts.metrics import RunMetrics
+from fts.ratelimiter import AdaptiveRateLimiter
+
+logger = logging.getLogger(__name__)
+
 
 class FTSException(Exception):
     pass
 
 
 class FTSDownload:
-    def __init__(self, configuration, downloader, countryisos=None, years=None, testfolder=None, testpath=False):
+    # Statuses worth retrying a GET for and those of them meaning the API wants us to slow down
+    retry_statuses = {429, 500, 502, 503, 504}
+    throttle_statuses = {429, 503}
+
+    def __init__(self, configuration, downloader, countryisos=None, years=None, testfolder=None, testpath=False,
+                 rate_limit=None, concurrency=1, downloader_factory=None, cache=None, metrics=None, retries=4,
+                 retry_backoff=1, archive=None, replay=False):
         self.url = configuration['base_url']
         self.test_url = configuration['test_url']
-        self.downloader = downloader
+        self.downloader = self.take_over_retries(downloader)
         if countryisos:
-            self.countryisos = countryisos.split(',')
+            self.countryisos = set(countryisos.split(','))
         else:
             self.countryisos = None
         if years:
-            self.years = years.split(',')
+            self.years = set(years.split(','))
         else:
             self.years = None
         self.testfolder = testfolder
         self.testpath = testpath
+        if rate_limit:
+            self.ratelimiter = AdaptiveRateLimiter(**rate_limit)
+        else:
+            self.ratelimiter = None
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        if downloader_factory is None:
+            # Download objects hold the current response so each worker thread needs its own
+            concurrency = 1
+        self.concurrency = concurrency
+        self.downloader_factory = downloader_factory
+        self.threadlocal = threading.local()
+        self.worker_downloaders = list()
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.cache = cache
+        # Responses are recorded into archive or, if replay is True, served from it
+        self.archive = archive
+        self.replay = replay
+        if metrics is None:
+            metrics = RunMetrics()
+        self.metrics = metrics
 
     def get_url(self, partial_url):
         return f'{self.url}{partial_url}'
@@ -48,13 +91,216 @@ class FTSDownload:
             filename = f'{filename}.json'
         return filename
 
+    def get_cache_key(self, url):
+        if url.startswith(self.test_url):
+            # Test files and nextLinks to them are already named by key
+            return url[len(self.test_url):]
+        if url.startswith(self.url):
+            partial_url = url[len(self.url):]
+        else:
+            split = urlsplit(url)
+            partial_url = split.path.lstrip('/')
+            if split.query:
+                partial_url = f'{partial_url}?{split.query}'
+        return self.get_testfile_path(partial_url)
+
+    @staticmethod
+    def take_over_retries(downloader):
+        '''
+        Stop downloader's session retrying so that get_response, which retries throttled, failed and unanswered
+        requests itself, sees throttling and can adapt the rate limit, and retries do not multiply.
+        '''
+        for adapter in downloader.session.adapters.values():
+            retries = getattr(adapter, 'max_retries', None)
+            if retries is not None:
+                adapter.max_retries = retries.new(total=0, connect=0, status_forcelist=None,
+                                                  respect_retry_after_header=False)
+        return downloader
+
+    def get_downloader(self):
+        downloader = getattr(self.threadlocal, 'downloader', None)
+        if downloader is not None:
+            return downloader
+        if self.downloader_factory is None or threading.current_thread() is threading.main_thread():
+            return self.downloader
+        # Stages running on other threads need their own downloader
+        self.setup_worker()
+        return self.threadlocal.downloader
+
+    def setup_worker(self):
+        downloader = self.take_over_retries(self.downloader_factory())
+        self.threadlocal.downloader = downloader
+        self.worker_downloaders.append(downloader)
+
+    def get_executor(self):
+        # Stages running at the same time can both ask for the executor first
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.concurrency, initializer=self.setup_worker)
+            return self.executor
+
+    def after_fork(self, processes):
+        '''
+        Set up in a forked worker process. Threads, connections and database handles from the parent cannot be used
+        and the rate limit is shared between the processes.
+        '''
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.threadlocal = threading.local()
+        self.worker_downloaders = list()
+        if self.downloader_factory is not None:
+            self.downloader = self.take_over_retries(self.downloader_factory())
+        if self.ratelimiter:
+            self.ratelimiter = self.ratelimiter.share(processes)
+        if self.cache is not None:
+            self.cache.reopen()
+        if self.archive is not None:
+            self.archive.reopen()
+
+    def close(self):
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+        for downloader in self.worker_downloaders:
+            downloader.close()
+        self.worker_downloaders = list()
+        if self.cache is not None:
+            self.cache.close()
+
+    @staticmethod
+    def get_retry_after(response):
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def get_response(self, url, stream=False, headers=None):
+        '''
+        GET url, retrying throttled (429 or 503), failed (5xx) and unanswered requests up to retries times with
+        exponential backoff and full jitter or for as long as Retry-After says. Throttling slows the rate limiter and
+        healthy responses speed it up. Returns the response, the number of retries and the number of throttles.
+        '''
+        retries = 0
+        throttles = 0
+        while True:
+            if self.ratelimiter:
+                self.ratelimiter.acquire()
+            try:
+                r = self.get_downloader().setup(url, stream=stream, headers=headers)
+            except DownloadError as ex:
+                response = getattr(ex.__cause__, 'response', None)
+                if response is None:
+                    status = None
+                    retry_after = None
+                else:
+                    status = response.status_code
+                    retry_after = self.get_retry_after(response)
+                if status in self.throttle_statuses:
+                    throttles += 1
+                    if self.ratelimiter:
+                        self.ratelimiter.throttle(retry_after)
+                if retries >= self.retries or (status is not None and status not in self.retry_statuses):
+                    ex.retries = retries
+                    ex.throttles = throttles
+                    ex.status = status
+                    raise
+                wait = random.uniform(0, self.retry_backoff * 2 ** retries)
+                if retry_after is not None:
+                    wait = max(wait, retry_after)
+                retries += 1
+                logger.warning(f'Retrying {url} in {wait:.1f}s after {status or ex.__cause__}')
+                time.sleep(wait)
+                continue
+            if self.ratelimiter:
+                self.ratelimiter.success()
+                self.metrics.set_rate(self.ratelimiter.rate * self.ratelimiter.period)
+            return r, retries, throttles
+
+    def record_error(self, url, start, ex):
+        self.metrics.record_request(url, time.perf_counter() - start, status=getattr(ex, 'status', None) or 'error',
+                                    retries=getattr(ex, 'retries', 0), throttles=getattr(ex, 'throttles', 0))
+
+    def replay_json(self, url):
+        start = time.perf_counter()
+        body = self.archive.get(self.get_cache_key(url))
+        if body is None:
+            raise FTSException(f'{url} is not in archive {self.archive.path}')
+        self.metrics.record_request(url, time.perf_counter() - start, len(body), status='replay')
+        return loads(body)
+
+    def record(self, url, body):
+        if self.archive is not None:
+            self.archive.set(self.get_cache_key(url), body)
+
+    def download_json(self, url):
+        if self.replay:
+            return self.replay_json(url)
+        key = None
+        entry = None
+        headers = None
+        start = time.perf_counter()
+        if self.cache is not None:
+            key = self.get_cache_key(url)
+            entry = self.cache.get(key)
+            if entry is not None:
+                if entry['fresh']:
+                    self.metrics.record_request(url, time.perf_counter() - start, status='cache', cache_hit=True)
+                    self.record(url, entry['body'])
+                    return loads(entry['body'])
+                headers = entry['validators']
+        try:
+            r, retries, throttles = self.get_response(url, headers=headers)
+        except Exception as ex:
+            self.record_error(url, start, ex)
+            raise
+        if entry is not None and r.status_code == 304:
+            self.cache.refresh(key, url)
+            self.metrics.record_request(url, time.perf_counter() - start, status=304, cache_hit=True,
+                                        retries=retries, throttles=throttles)
+            self.record(url, entry['body'])
+            return loads(entry['body'])
+        body = r.content
+        self.record(url, body)
+        self.metrics.record_request(url, time.perf_counter() - start, len(body), r.status_code, retries=retries,
+                                    throttles=throttles)
+        origjson = loads(body)
+        if key is not None and origjson.get('status') == 'ok':
+            self.cache.set(key, url, body, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return origjson
+
+    def keep_plan(self, plan):
+        if self.countryisos:
+            countries = plan['countries']
+            if countries and not any(country['iso3'] in self.countryisos for country in countries):
+                return False
+        if self.years:
+            if not any(year['year'] in self.years for year in plan['usageYears']):
+                return False
+        return True
+
+    def keep_object(self, object):
+        if self.countryisos and 'iso3' in object:
+            if object['iso3'] not in self.countryisos:
+                return False
+        if self.years and 'year' in object:
+            if str(object['year']) not in self.years:
+                return False
+        return True
+
     def download(self, partial_url=None, data=True, url=None):
         if self.testpath:
             partial_url = self.get_testfile_path(partial_url, url)
         if partial_url is not None:
             url = self.get_url(partial_url)
-        r = self.downloader.download(url)
-        origjson = r.json()
+        origjson = self.download_json(url)
         status = origjson['status']
         if status != 'ok':
             raise FTSException(f'{url} gives status {status}')
@@ -71,37 +317,12 @@ class FTSDownload:
                     pass
                 plans = json.get('plans')
                 if plans is not None:
-                    for i, plan in reversed(list(enumerate(plans))):
-                        delete = False
-                        if self.countryisos:
-                            countries = plan['countries']
-                            if countries:
-                                delete = True
-                                for country in countries:
-                                    if country['iso3'] in self.countryisos:
-                                        delete = False
-                                        break
-                        if not delete and self.years:
-                            delete = True
-                            for year in plan['usageYears']:
-                                if year['year'] in self.years:
-                                    delete = False
-                                    break
-                        if delete:
-                            del plans[i]
+                    if self.countryisos or self.years:
+                        plans[:] = [plan for plan in plans if self.keep_plan(plan)]
                     if len(plans) == 0:
                         save = False
             elif self.countryisos or self.years:
-                for i, object in reversed(list(enumerate(json))):
-                    if 'iso3' in object:
-                        countryiso = object['iso3']
-                        if countryiso is None or countryiso not in self.countryisos:
-                            del json[i]
-                            continue
-                    if 'year' in object:
-                        year = str(object['year'])
-                        if year is None or year not in self.years:
-                            del json[i]
+                json[:] = [object for object in json if self.keep_object(object)]
         else:
             json = origjson
         if save and self.testfolder and json:
@@ -121,4 +342,100 @@ class FTSDownload:
                 save_json(origjson, filepath)
         return json
 
+    def download_within(self, context, partial_url=None, data=True, url=None):
+        with self.metrics.within(context):
+            return self.download(partial_url, data, url)
 
+    def download_batch(self, partial_urls=None, data=True, urls=None, return_exceptions=False):
+        '''
+        Download a list of partial urls (or full urls) with up to concurrency requests in flight, returning the
+        results in the same order as the input. Any exception raised by a download is raised here unless
+        return_exceptions is True in which case it is returned in place of that url's result.
+        '''
+        if partial_urls is not None:
+            args = [(partial_url, None) for partial_url in partial_urls]
+        else:
+            args = [(None, url) for url in urls]
+        results = list()
+        if self.concurrency == 1 or len(args) < 2:
+            for partial_url, url in args:
+                try:
+                    results.append(self.download(partial_url, data, url))
+                except Exception as ex:
+                    if not return_exceptions:
+                        raise
+                    results.append(ex)
+            return results
+        executor = self.get_executor()
+        context = self.metrics.get_context()
+        futures = [executor.submit(self.download_within, context, partial_url, data, url) for partial_url, url in args]
+        for future in futures:
+            exception = future.exception()
+            if exception is None:
+                results.append(future.result())
+            elif return_exceptions:
+                results.append(exception)
+            else:
+                raise exception
+        return results
+
+    def stream_flows(self, url):
+        '''
+        Parse the flows in a custom search response one at a time as the body is read rather than decoding the whole
+        page. Yields each flow and returns the url of the next page if there is one.
+        '''
+        if self.testpath:
+            url = self.get_url(self.get_testfile_path(None, url))
+        start = time.perf_counter()
+        try:
+            r, retries, throttles = self.get_response(url, stream=True)
+        except Exception as ex:
+            self.record_error(url, start, ex)
+            raise
+        size = 0
+        events = ijson.sendable_list()
+        parser = ijson.parse_coro(events, use_float=True)
+        status = None
+        nextlink = None
+        builder = None
+        for chunk in r.iter_content(chunk_size=65536):
+            size += len(chunk)
+            parser.send(chunk)
+            for prefix, event, value in events:
+                if builder is not None:
+                    builder.event(event, value)
+                    if prefix == 'data.flows.item' and event == 'end_map':
+                        yield builder.value
+                        builder = None
+                elif prefix == 'data.flows.item' and event == 'start_map':
+                    builder = ObjectBuilder()
+                    builder.event(event, value)
+                elif prefix == 'status':
+                    status = value
+                    if status != 'ok':
+                        raise FTSException(f'{url} gives status {status}')
+                elif prefix == 'meta.nextLink':
+                    nextlink = value
+            del events[:]
+        parser.close()
+        self.metrics.record_request(url, time.perf_counter() - start, size, r.status_code, retries=retries,
+                                    throttles=throttles)
+        if status is None:
+            raise FTSException(f'{url} has no status')
+        return nextlink
+
+    def download_flows(self, url):
+        '''
+        Iterate over all flows from a custom search url following nextLink through every page. Flows are streamed
+        unless the whole response is needed for the cache (if it has a rule for the url), the archive or for saving
+        test data.
+        '''
+        while url:
+            cached = self.cache is not None and self.cache.get_ttl(url) is not None
+            if self.testfolder or cached or self.archive is not None:
+                json = self.download(url=url, data=False)
+                for flow in json['data']['flows']:
+                    yield flow
+                url = json['meta'].get('nextLink')
+            else:
+                url = yield from self.stream_flows(url)
@@ -1,140 +1,290 @@
 import logging
+from urllib.parse import quote
 
-from hdx.utilities.dictandlist import dict_of_lists_add
 from hdx.utilities.text import multiple_replace
 
-from fts.helpers import country_all_columns_to_keep, rename_columns, funding_hxl_names
+from fts.helpers import country_all_columns_to_keep, rename_columns, funding_hxl_names, \
+    generate_resource_from_iterator
+from fts.partitions import FlowPartitions
+from fts.sorter import ExternalSorter
 
 logger = logging.getLogger(__name__)
 
 srcdestmap = {'sourceObjects': 'src', 'destinationObjects': 'dest'}
+replacements = {'OrganizationOrganization': 'Organization', 'Name': '', 'types': 'Types', 'code': 'Code'}
+columns_to_keep = set(country_all_columns_to_keep)
+date_columns = {'date', 'firstReportedDate', 'decisionDate', 'createdAt', 'updatedAt'}
+# Flattened rows hold lists in these columns which are comma joined for the CSVs
+list_columns = ('srcOrganizationTypes', 'srcLocations', 'destOrganizationTypes', 'destGlobalClusters', 'destLocations',
+                'keywords')
 
 
 class Flows:
-    def __init__(self, downloader, locations, planidcodemapping):
+    def __init__(self, downloader, locations, planidcodemapping, flowstore=None, sort_buffer_rows=100000,
+                 export=None):
         self.downloader = downloader
         self.locations = locations
         self.planidcodemapping = planidcodemapping
+        self.flowstore = flowstore
+        self.sort_buffer_rows = sort_buffer_rows
+        self.export = export
+        self.column_mappings = dict()
+        self.partitions = None
+        self.partitions_year = None
+
+    @staticmethod
+    def get_column_mapping(shortened, objtype, key):
+        '''
+        Work out the output column for a key of a source or destination object type and how its values are
+        aggregated: years (start and end columns), locations (sorted ISO3s), list (sorted) or single (value or
+        Multiple). Returns None if the column is not kept.
+        '''
+        keyname = multiple_replace(f'{shortened}{objtype}{key.capitalize()}', replacements)
+        if 'UsageYear' in keyname:
+            endcolumn = f'{keyname}End'
+            if endcolumn not in columns_to_keep:
+                endcolumn = None
+            return 'years', f'{keyname}Start', endcolumn
+        if any(x in keyname for x in ['Cluster', 'Location', 'OrganizationTypes']):
+            if keyname[-1] != 's':
+                keyname = f'{keyname}s'
+            if 'Location' in keyname:
+                rule = 'locations'
+            else:
+                rule = 'list'
+        else:
+            rule = 'single'
+        if keyname not in columns_to_keep:
+            return None
+        return rule, keyname, None
 
     def flatten_objects(self, objs, shortened, newrow):
-        objinfo_by_type = dict()
+        column_mappings = self.column_mappings
+        values_by_key = dict()
         plan_id = None
         destPlanId = None
         for obj in objs:
             objtype = obj['type']
-            objinfo = objinfo_by_type.get(objtype, dict())
-            for key in obj:
-                if objtype == 'Plan' and key == 'id':
-                    plan_id = obj[key]
-                    dict_of_lists_add(objinfo, key, plan_id)
+            for key, value in obj.items():
+                if key == 'id':
+                    if objtype != 'Plan':
+                        continue
+                    plan_id = value
                     if shortened == 'dest':
                         destPlanId = plan_id
-                if key not in ['type', 'behavior', 'id']:
-                    value = obj[key]
-                    if isinstance(value, list):
-                        for element in value:
-                            dict_of_lists_add(objinfo, key, element)
+                elif key == 'type' or key == 'behavior':
+                    continue
+                mappingkey = (shortened, objtype, key)
+                try:
+                    mapping = column_mappings[mappingkey]
+                except KeyError:
+                    mapping = self.get_column_mapping(shortened, objtype, key)
+                    column_mappings[mappingkey] = mapping
+                if mapping is None:
+                    continue
+                if isinstance(value, list):
+                    if not value:
+                        continue
+                    values = values_by_key.get(mappingkey)
+                    if values is None:
+                        values_by_key[mappingkey] = list(value)
                     else:
-                        dict_of_lists_add(objinfo, key, value)
-            objinfo_by_type[objtype] = objinfo
-        for objtype in objinfo_by_type:
-            prefix = '%s%s' % (shortened, objtype)
-            for key in objinfo_by_type[objtype]:
-                keyname = '%s%s' % (prefix, key.capitalize())
-                values = objinfo_by_type[objtype][key]
-                replacements = {'OrganizationOrganization': 'Organization', 'Name': '', 'types': 'Types',
-                                'code': 'Code'}
-                keyname = multiple_replace(keyname, replacements)
-                if 'UsageYear' in keyname:
-                    values = sorted(values)
-                    newrow['%sStart' % keyname] = values[0]
-                    outputstr = values[-1]
-                    keyname = '%sEnd' % keyname
-                elif any(x in keyname for x in ['Cluster', 'Location', 'OrganizationTypes']):
-                    if keyname[-1] != 's':
-                        keyname = '%ss' % keyname
-                    if 'Location' in keyname:
-                        iso3s = list()
-                        for country in values:
-                            iso3 = self.locations.get_countryiso_from_name(country)
-                            if iso3:
-                                iso3s.append(iso3)
-                        values = iso3s
-                    outputstr = ','.join(sorted(values))
+                        values.extend(value)
                 else:
-                    if len(values) > 1:
-                        outputstr = 'Multiple'
-                        logger.error(f'Multiple used instead of {values} for {keyname} in {plan_id} ({shortened})')
+                    values = values_by_key.get(mappingkey)
+                    if values is None:
+                        values_by_key[mappingkey] = [value]
                     else:
-                        outputstr = values[0]
-                if keyname in country_all_columns_to_keep:
-                    newrow[keyname] = outputstr
+                        values.append(value)
+        for mappingkey, values in values_by_key.items():
+            rule, column, endcolumn = column_mappings[mappingkey]
+            if rule == 'single':
+                if len(values) > 1:
+                    newrow[column] = 'Multiple'
+                    logger.error(f'Multiple used instead of {values} for {column} in {plan_id} ({shortened})')
+                else:
+                    newrow[column] = values[0]
+            elif rule == 'years':
+                newrow[column] = min(values)
+                if endcolumn:
+                    newrow[endcolumn] = max(values)
+            elif rule == 'locations':
+                iso3s = list()
+                for country in values:
+                    iso3 = self.locations.get_countryiso_from_name(country)
+                    if iso3:
+                        iso3s.append(iso3)
+                newrow[column] = sorted(iso3s)
+            else:
+                newrow[column] = sorted(values)
         return destPlanId
 
+    def get_flows(self, country, year, watermark=None):
+        partial_url = f'1/fts/flow/custom-search?locationid={country["id"]}&year={year}'
+        if watermark:
+            partial_url = f'{partial_url}&{self.flowstore.parameter}={quote(watermark)}'
+        return self.downloader.download_flows(self.downloader.get_url(partial_url))
+
+    @staticmethod
+    def get_boundary_side(objs, year):
+        '''
+        Get the ids of the locations on one side of a flow if that side's usage years include year (otherwise the
+        flow does not cross a boundary on that side) and whether any of that side's locations or years are shared.
+        '''
+        locationids = set()
+        inyear = False
+        shared = False
+        for obj in objs:
+            objtype = obj['type']
+            if objtype == 'Location':
+                locationids.add(int(obj['id']))
+            elif objtype == 'UsageYear':
+                if obj['name'] == year:
+                    inyear = True
+            else:
+                continue
+            if obj.get('behavior') == 'shared':
+                shared = True
+        if not inyear:
+            locationids = set()
+        return locationids, shared
+
+    @classmethod
+    def get_boundaries(cls, flow, countryids, year):
+        '''
+        Work out the boundary (incoming, outgoing or internal) and onBoundary (single or shared) the per location
+        custom search would give flow for each country in countryids that it touches in year.
+        '''
+        srcids, srcshared = cls.get_boundary_side(flow['sourceObjects'], year)
+        destids, destshared = cls.get_boundary_side(flow['destinationObjects'], year)
+        for countryid in sorted((srcids | destids) & countryids):
+            insrc = countryid in srcids
+            indest = countryid in destids
+            # New money is never internal: FTS counts it as coming into the country even from a source there
+            if insrc and indest and not flow.get('newMoney'):
+                boundary = 'internal'
+                shared = srcshared or destshared
+            elif indest:
+                boundary = 'incoming'
+                shared = destshared
+            else:
+                boundary = 'outgoing'
+                shared = srcshared
+            yield countryid, boundary, 'shared' if shared else 'single'
+
+    def sweep_flows(self, year, folder=None):
+        '''
+        Download every flow for year in one global paginated sweep rather than one search per country and
+        partition them by country, putting a flow into every country it touches with the boundary for that country.
+        '''
+        countryids = {country['id']: country['iso3'] for country in self.locations.countries}
+        partitions = FlowPartitions(folder)
+        count = 0
+        url = self.downloader.get_url(f'1/fts/flow/custom-search?year={year}')
+        with self.downloader.metrics.staged('flows'):
+            for flow in self.downloader.download_flows(url):
+                count += 1
+                for countryid, boundary, onboundary in self.get_boundaries(flow, countryids.keys(), year):
+                    partitions.add(countryids[countryid], {**flow, 'boundary': boundary, 'onBoundary': onboundary})
+        logger.info(f'Partitioned {count} flows in {year} across {len(partitions.files)} countries')
+        if self.partitions is not None:
+            self.partitions.close()
+        self.partitions = partitions
+        self.partitions_year = year
+
+    def harvest_flows(self, country, year):
+        countryiso = country['iso3']
+        watermark = self.flowstore.get_watermark(countryiso, year)
+        count = self.flowstore.store_flows(countryiso, year, self.get_flows(country, year, watermark), watermark)
+        if watermark and self.flowstore.parameter_honoured:
+            logger.info(f'{count} flows for {countryiso} in {year} created or updated since {watermark}')
+        else:
+            logger.info(f'{count} flows for {countryiso} in {year} harvested in full')
+        return self.flowstore.get_flows(countryiso, year)
+
+    def flatten_flow(self, row):
+        newrow = dict()
+        destPlanId = None
+        for key in row:
+            if key == 'reportDetails':
+                continue
+            value = row[key]
+            shortened = srcdestmap.get(key)
+            if shortened:
+                newdestPlanId = self.flatten_objects(value, shortened, newrow)
+                if newdestPlanId:
+                    destPlanId = int(newdestPlanId)
+                continue
+            if key == 'keywords':
+                if value:
+                    newrow[key] = list(value)
+                else:
+                    newrow[key] = ''
+                continue
+            if key in date_columns:
+                if value:
+                    newrow[key] = value[:10]
+                else:
+                    newrow[key] = ''
+                continue
+            renamed_column = rename_columns.get(key)
+            if renamed_column:
+                newrow[renamed_column] = value
+                continue
+            if key in columns_to_keep:
+                newrow[key] = value
+        if 'originalAmount' not in newrow:
+            newrow['originalAmount'] = ''
+        if 'originalCurrency' not in newrow:
+            newrow['originalCurrency'] = ''
+        if 'refCode' not in newrow:
+            newrow['refCode'] = ''
+        newrow['destPlanCode'] = self.planidcodemapping.get(destPlanId, '')
+        return newrow
+
+    def get_csv_rows(self, rows, countryiso, year):
+        for row in rows:
+            if self.export is not None:
+                self.export.add('flows', countryiso, year, row)
+            for column in list_columns:
+                value = row.get(column)
+                if isinstance(value, list):
+                    row[column] = ','.join(value)
+            yield row
+
     def generate_resources(self, folder, dataset, latestyear, country):
-        fund_boundaries_info = dict()
-        fund_data = list()
-        base_funding_url = f'1/fts/flow/custom-search?locationid={country["id"]}&'
-        funding_url = self.downloader.get_url(f'{base_funding_url}year={latestyear}')
-        while funding_url:
-            json = self.downloader.download(url=funding_url, data=False)
-            fund_data.extend(json['data']['flows'])
-            funding_url = json['meta'].get('nextLink')
-
-        for row in fund_data:
-            newrow = dict()
-            destPlanId = None
-            for key in row:
-                if key == 'reportDetails':
-                    continue
-                value = row[key]
-                shortened = srcdestmap.get(key)
-                if shortened:
-                    newdestPlanId = self.flatten_objects(value, shortened, newrow)
-                    if newdestPlanId:
-                        destPlanId = int(newdestPlanId)
-                    continue
-                if key == 'keywords':
-                    if value:
-                        newrow[key] = ','.join(value)
-                    else:
-                        newrow[key] = ''
-                    continue
-                if key in ['date', 'firstReportedDate', 'decisionDate', 'createdAt', 'updatedAt']:
-                    if value:
-                        newrow[key] = value[:10]
-                    else:
-                        newrow[key] = ''
-                    continue
-                renamed_column = rename_columns.get(key)
-                if renamed_column:
-                    newrow[renamed_column] = value
-                    continue
-                if key in country_all_columns_to_keep:
-                    newrow[key] = value
-            if 'originalAmount' not in newrow:
-                newrow['originalAmount'] = ''
-            if 'originalCurrency' not in newrow:
-                newrow['originalCurrency'] = ''
-            if 'refCode' not in newrow:
-                newrow['refCode'] = ''
-            newrow['destPlanCode'] = self.planidcodemapping.get(destPlanId, '')
-            boundary = row['boundary']
-            rows = fund_boundaries_info.get(boundary, list())
-            rows.append(newrow)
-            fund_boundaries_info[boundary] = rows
+        sorters = dict()
+        if self.partitions is not None and self.partitions_year == latestyear:
+            flows = self.partitions.get(country['iso3'])
+        elif self.flowstore is None:
+            flows = self.get_flows(country, latestyear)
+        else:
+            flows = self.harvest_flows(country, latestyear)
+        with self.downloader.metrics.staged('flows'):
+            for row in flows:
+                newrow = self.flatten_flow(row)
+                boundary = row['boundary']
+                sorter = sorters.get(boundary)
+                if sorter is None:
+                    sorter = ExternalSorter(key=lambda k: k['date'], reverse=True,
+                                            buffer_rows=self.sort_buffer_rows, folder=folder)
+                    sorters[boundary] = sorter
+                sorter.add(newrow)
 
         resources = list()
-        for boundary in sorted(fund_boundaries_info.keys()):
-            rows = sorted(fund_boundaries_info[boundary], key=lambda k: k['date'], reverse=True)
-            headers = list(funding_hxl_names.keys())
+        headers = list(funding_hxl_names.keys())
+        for boundary in sorted(sorters.keys()):
             filename = f'fts_{boundary}_funding_{country["iso3"].lower()}.csv'
             resourcedata = {
                 'name': filename,
                 'description': f'FTS {boundary.capitalize()} Funding Data for {country["name"]} for {latestyear}',
                 'format': 'csv'
             }
-            success, results = dataset.generate_resource_from_iterator(headers, rows, funding_hxl_names, folder, filename, resourcedata)
-            if success:
-                resources.append(results['resource'])
-        return resources
\ No newline at end of file
+            rows = self.get_csv_rows(sorters[boundary], country['iso3'], latestyear)
+            with self.downloader.metrics.timed_csv():
+                resources.append(generate_resource_from_iterator(dataset, headers, rows, funding_hxl_names, folder,
+                                                                 filename, resourcedata))
+            sorters[boundary].close()
+        if self.export is not None:
+            self.export.write('flows', country['iso3'])
+        return resources
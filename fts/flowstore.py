@@ -0,0 +1,105 @@
+import json
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class FlowStore:
+    '''
+    SQLite store of the flows last harvested for each country and year. Flows are held by id, which is the order a
+    full harvest returns them in, along with the highest updatedAt (the watermark) and the date of the last full
+    harvest. Incremental harvests add the watermark to the flows query in parameter. If the API turns out to ignore
+    parameter, the flows it returned are stored as a full harvest and later harvests are full.
+    '''
+    def __init__(self, path, parameter, reconcile_days=7, today=None):
+        self.parameter = parameter
+        self.parameter_honoured = True
+        self.reconcile_days = reconcile_days
+        if today is None:
+            today = datetime.now()
+        self.today = today
+        self.path = path
+        self.reopen()
+        self.connection.execute('CREATE TABLE IF NOT EXISTS flows (countryiso TEXT, year TEXT, id INTEGER, '
+                                'flow TEXT, PRIMARY KEY (countryiso, year, id))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS harvests (countryiso TEXT, year TEXT, watermark TEXT, '
+                                'reconciled TEXT, PRIMARY KEY (countryiso, year))')
+        self.connection.commit()
+
+    def reopen(self):
+        self.connection = sqlite3.connect(self.path, timeout=60)
+
+    def get_watermark(self, countryiso, year):
+        '''
+        Get the updatedAt watermark from which to harvest incrementally or None if a full harvest is needed because
+        there is no previous harvest, the last full one is older than reconcile_days or the API ignores parameter.
+        '''
+        if not self.parameter_honoured:
+            return None
+        result = self.connection.execute('SELECT watermark, reconciled FROM harvests WHERE countryiso=? AND year=?',
+                                         (countryiso, year)).fetchone()
+        if result is None:
+            return None
+        watermark, reconciled = result
+        if not watermark:
+            return None
+        if datetime.fromisoformat(reconciled) + timedelta(days=self.reconcile_days) <= self.today:
+            logger.info(f'Reconciling all {year} flows for {countryiso}')
+            return None
+        return watermark
+
+    def store_flows(self, countryiso, year, flows, watermark=None):
+        '''
+        Store flows for country and year. If watermark is None, the flows are a full harvest and replace what was
+        there, otherwise they are merged by id with the existing flows. A flow last updated before the watermark
+        means the API ignored it and returned every flow, so the flows are then stored as a full harvest. Returns the
+        number of flows stored.
+        '''
+        cursor = self.connection.cursor()
+        if watermark is None:
+            cursor.execute('DELETE FROM flows WHERE countryiso=? AND year=?', (countryiso, year))
+        full = watermark is None
+        seen = list()
+        newwatermark = watermark
+        count = 0
+        for flow in flows:
+            updated = flow.get('updatedAt')
+            if not full and updated and updated < watermark:
+                logger.warning(f'FTS ignored {self.parameter}={watermark} for {countryiso} in {year} so harvesting '
+                               f'all flows in full from now on')
+                self.parameter_honoured = False
+                full = True
+            # Flows already stored are still part of a full harvest should the API turn out to ignore the watermark
+            seen.append((flow['id'],))
+            if not full and updated and updated <= watermark:
+                continue
+            if updated and (newwatermark is None or updated > newwatermark):
+                newwatermark = updated
+            cursor.execute('INSERT OR REPLACE INTO flows (countryiso, year, id, flow) VALUES (?, ?, ?, ?)',
+                           (countryiso, year, flow['id'], json.dumps(flow)))
+            count += 1
+        if full and watermark is not None:
+            # Flows merged before the API was found to ignore the watermark are part of the full harvest too
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS seen (id INTEGER PRIMARY KEY)')
+            cursor.execute('DELETE FROM seen')
+            cursor.executemany('INSERT OR IGNORE INTO seen VALUES (?)', seen)
+            cursor.execute('DELETE FROM flows WHERE countryiso=? AND year=? AND id NOT IN (SELECT id FROM seen)',
+                           (countryiso, year))
+        if full:
+            cursor.execute('INSERT OR REPLACE INTO harvests VALUES (?, ?, ?, ?)',
+                           (countryiso, year, newwatermark, self.today.isoformat()))
+        else:
+            cursor.execute('UPDATE harvests SET watermark=? WHERE countryiso=? AND year=?',
+                           (newwatermark, countryiso, year))
+        self.connection.commit()
+        return count
+
+    def get_flows(self, countryiso, year):
+        for flow, in self.connection.execute('SELECT flow FROM flows WHERE countryiso=? AND year=? ORDER BY id',
+                                             (countryiso, year)):
+            yield json.loads(flow)
+
+    def close(self):
+        self.connection.close()
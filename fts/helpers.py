@@ -1,5 +1,10 @@
+from os.path import join
+
 from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
 from hdx.data.showcase import Showcase
+from hdx.utilities.dictandlist import write_list_to_csv
+from hdx.utilities.downloader import Download
 
 funding_hxl_names = {
     'date': '#date',
@@ -101,4 +106,25 @@ def get_dataset_and_showcase(slugified_name, title, description, today, countryi
         'image_url': f'https://reliefweb.int/sites/reliefweb.int/files/styles/location-image/public/country-location-images/{countryiso.lower()}.png'
     })
     showcase.add_tags(tags)
-    return dataset, showcase
\ No newline at end of file
+    return dataset, showcase
+
+
+def generate_resource_from_iterator(dataset, headers, iterator, hxltags, folder, filename, resourcedata,
+                                    dict_form=True):
+    '''
+    Write rows from iterator to csv as they are produced (Dataset.generate_resource_from_iterator collects every row
+    in a list first) and add a resource for the file to the dataset. Rows are dictionaries or, if dict_form is False,
+    sequences of values in the order of headers.
+    '''
+    def get_rows():
+        yield Download.hxl_row(headers, hxltags, dict_form=dict_form)
+        for row in iterator:
+            yield row
+
+    filepath = join(folder, filename)
+    write_list_to_csv(filepath, get_rows, headers=headers)
+    resource = Resource(resourcedata)
+    resource.set_file_type('csv')
+    resource.set_file_to_upload(filepath)
+    dataset.add_update_resource(resource)
+    return resource
@@ -8,11 +8,14 @@ Generates FTS datasets.
 
 '''
 import logging
+import time
+from functools import partial
 
 from hdx.data.hdxobject import HDXError
 from hdx.utilities.dictandlist import dict_of_lists_add
 from slugify import slugify
 
+from fts.dag import StageGraph
 from fts.flows import Flows
 from fts.helpers import get_dataset_and_showcase
 from fts.requirements_funding import RequirementsFunding
@@ -21,49 +24,191 @@ from fts.requirements_funding_cluster import RequirementsFundingCluster
 
 logger = logging.getLogger(__name__)
 
+country_fields = ('id', 'iso3', 'requirements', 'funding', 'percentFunded')
+
+
+def slim_plan(plan):
+    '''
+    Keep only the fields of a plan that are read once requirements and funding have been added to its countries or
+    that the country and year filters check.
+    '''
+    countries = list()
+    for country in plan['countries']:
+        slim_country = {field: country[field] for field in country_fields if field in country}
+        slim_country['adminlevel'] = country.get('adminlevel', country.get('adminLevel'))
+        countries.append(slim_country)
+    return {'id': plan['id'], 'code': plan['code'], 'name': plan['name'], 'planType': {'id': plan['planType']['id']},
+            'startDate': plan['startDate'], 'endDate': plan['endDate'], 'countries': countries,
+            'usageYears': [{'year': year['year']} for year in plan['usageYears']]}
+
 
 class FTS:
-    def __init__(self, downloader, locations, today, notes, start_year=1998):
+    def __init__(self, downloader, locations, today, notes, start_year=1998, flowstore=None, sort_buffer_rows=100000,
+                 export=None, global_flows=False, planindex=None, state=None, stage_workers=1):
         self.downloader = downloader
         self.locations = locations
         self.today = today
         self.notes = notes
+        self.export = export
+        self.planindex = planindex
+        self.timings = dict()
         self.plans_by_year_by_country = dict()
         self.planidcodemapping = dict()
         self.planidswithonelocation = set()
         self.globalplanids = set()
-        self.reqfund = RequirementsFunding(downloader, locations, self.globalplanids, today)
-        self.get_plans(start_year=start_year)
-        self.flows = Flows(downloader, locations, self.planidcodemapping)
-        self.others = self.setup_others(downloader, locations)
+        self.reqfund = RequirementsFunding(downloader, locations, self.globalplanids, today, export)
+        self.flows = Flows(downloader, locations, self.planidcodemapping, flowstore, sort_buffer_rows, export)
+        self.others = self.setup_clusters()
+        # Stages run as soon as the stages they need have finished, independent ones at the same time if
+        # stage_workers > 1
+        self.graph = StageGraph()
+        if state is None:
+            self.add_stage('plans', self.get_plans, start_year=start_year)
+            self.add_stage('covid', self.setup_covid, requires=('plans',))
+            self.add_stage('clusters', self.prefetch_cluster_breakdowns, requires=('plans',))
+            self.add_stage('trends', self.reqfund.precompute_country_funding, locations.countries,
+                           self.plans_by_year_by_country, requires=('plans',))
+        else:
+            self.set_state(state)
+        # A global sweep of flows does not need plans so runs alongside them. Without one, each country's flows are
+        # searched as the country is generated, so only the countries still to be generated are searched.
+        if global_flows:
+            self.add_stage('flows', self.flows.sweep_flows, str(today.year))
+        self.graph.run(stage_workers)
+        if self.graph.stages:
+            path, seconds = self.graph.get_critical_path()
+            logger.info(f'Critical path {" -> ".join(path)} took {seconds:.1f}s')
+
+    def get_state(self):
+        '''
+        Get everything worked out before the first country is generated so that it can be saved and passed to other
+        runs (see fts.shards) instead of them downloading it all again.
+        '''
+        return {'plans_by_year_by_country': self.plans_by_year_by_country,
+                'planidcodemapping': self.planidcodemapping,
+                'planidswithonelocation': self.planidswithonelocation,
+                'globalplanids': self.globalplanids,
+                'funding_by_year_by_country': self.reqfund.funding_by_year_by_country,
+                'covidfundingbyplanandlocation': self.others['covid'].covidfundingbyplanandlocation,
+                'cluster_breakdowns': self.others['cluster'].breakdowns,
+                'globalcluster_breakdowns': self.others['globalcluster'].breakdowns,
+                'timings': self.timings}
+
+    def set_state(self, state):
+        # Mappings are updated in place as other objects hold references to them
+        self.plans_by_year_by_country.update(state['plans_by_year_by_country'])
+        self.planidcodemapping.update(state['planidcodemapping'])
+        self.planidswithonelocation.update(state['planidswithonelocation'])
+        self.globalplanids.update(state['globalplanids'])
+        self.reqfund.funding_by_year_by_country = state['funding_by_year_by_country']
+        self.others['covid'] = RequirementsFundingCovid(self.downloader, self.locations, dict(), self.export)
+        self.others['covid'].covidfundingbyplanandlocation = state['covidfundingbyplanandlocation']
+        self.others['cluster'].breakdowns = state['cluster_breakdowns']
+        self.others['globalcluster'].breakdowns = state['globalcluster_breakdowns']
+        self.timings.update(state['timings'])
+
+    def after_fork(self, processes):
+        self.downloader.after_fork(processes)
+        if self.flows.flowstore is not None:
+            self.flows.flowstore.reopen()
 
-    def setup_others(self, downloader, locations):
-        covid = RequirementsFundingCovid(downloader, locations, self.plans_by_year_by_country)
-        cluster = RequirementsFundingCluster(downloader, self.planidswithonelocation)
-        globalcluster = RequirementsFundingCluster(downloader, self.planidswithonelocation, clusterlevel='global')
-        return {'covid': covid, 'cluster': cluster, 'globalcluster': globalcluster}
+    def timed(self, stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        with self.downloader.metrics.staged(stage):
+            result = function(*args, **kwargs)
+        self.timings[stage] = time.perf_counter() - start
+        logger.info(f'Stage {stage} took {self.timings[stage]:.1f}s')
+        return result
+
+    def add_stage(self, stage, function, *args, requires=(), **kwargs):
+        self.graph.add(stage, partial(self.timed, stage, function, *args, **kwargs), requires)
+
+    def setup_clusters(self):
+        cluster = RequirementsFundingCluster(self.downloader, self.planidswithonelocation, export=self.export)
+        globalcluster = RequirementsFundingCluster(self.downloader, self.planidswithonelocation, clusterlevel='global',
+                                                   export=self.export)
+        return {'cluster': cluster, 'globalcluster': globalcluster}
+
+    def setup_covid(self):
+        self.others['covid'] = RequirementsFundingCovid(self.downloader, self.locations, self.plans_by_year_by_country,
+                                                        self.export)
+
+    def prefetch_cluster_breakdowns(self):
+        planids = self.planidswithonelocation - self.globalplanids
+        self.others['cluster'].prefetch_breakdowns(planids)
+        self.others['globalcluster'].prefetch_breakdowns(planids)
 
     def get_plans(self, start_year=1998):
-        for year in range(self.today.year, start_year, -1):
-            data = self.downloader.download(f'2/fts/flow/plan/overview/progress/{year}')
-            plans = data['plans']
-            for plan in plans:
-                planid = plan['id']
-                self.planidcodemapping[planid] = plan['code']
-                countries = plan['countries']
-                if countries:
-                    is_global = self.reqfund.add_country_requirements_funding(planid, plan, countries)
-                    if is_global:
-                        self.globalplanids.add(planid)
-                    if len(countries) == 1:
-                        self.planidswithonelocation.add(planid)
-                    for country in countries:
-                        countryiso = country['iso3']
-                        if not countryiso:
-                            continue
-                        plans_by_year = self.plans_by_year_by_country.get(countryiso, {})
-                        dict_of_lists_add(plans_by_year, year, plan)
-                        self.plans_by_year_by_country[countryiso] = plans_by_year
+        # Every year is downloaded even when only some years are asked for, as plans are listed under one year but
+        # kept if any of their usage years is asked for
+        years = list(range(self.today.year, start_year, -1))
+        indexed = 0
+        # Years are loaded a few at a time and slimmed so that the full plan payloads of every year are never in
+        # memory together
+        chunk_size = max(self.downloader.concurrency, 1)
+        for i in range(0, len(years), chunk_size):
+            chunk = years[i:i + chunk_size]
+            indexed_by_year = dict()
+            if self.planindex is not None:
+                for year in chunk:
+                    plans = self.planindex.load(year)
+                    if plans is not None:
+                        # The snapshot holds every plan so filter it as downloading the year would
+                        if self.downloader.countryisos or self.downloader.years:
+                            plans = [(plan, is_global) for plan, is_global in plans if self.downloader.keep_plan(plan)]
+                        indexed_by_year[year] = plans
+                indexed += len(indexed_by_year)
+            download_years = [year for year in chunk if year not in indexed_by_year]
+            partial_urls = [f'2/fts/flow/plan/overview/progress/{year}' for year in download_years]
+            plans_by_year = dict()
+            for year, data in zip(download_years, self.downloader.download_batch(partial_urls)):
+                plans_by_year[year] = data['plans']
+            with self.downloader.metrics.staged('requirements_funding'):
+                self.reqfund.download_location_breakdowns(plans_by_year)
+            for year in chunk:
+                plans = indexed_by_year.get(year)
+                if plans is None:
+                    plans = self.process_plans(plans_by_year.pop(year))
+                    # A snapshot of plans filtered by country or year would be missing plans on the next run
+                    if self.planindex is not None and not self.downloader.countryisos and not self.downloader.years:
+                        self.planindex.store(year, plans)
+                for plan, is_global in plans:
+                    self.add_plan(year, plan, is_global)
+        if indexed:
+            logger.info(f'Loaded plans for {indexed} closed years from plan index')
+
+    def process_plans(self, plans):
+        '''
+        Add per country requirements and funding to plans, returning a list of each slimmed plan and whether it is
+        global.
+        '''
+        processed = list()
+        for plan in plans:
+            countries = plan['countries']
+            is_global = False
+            if countries:
+                with self.downloader.metrics.staged('requirements_funding'):
+                    is_global = self.reqfund.add_country_requirements_funding(plan['id'], plan, countries)
+            processed.append((slim_plan(plan), is_global))
+        return processed
+
+    def add_plan(self, year, plan, is_global):
+        planid = plan['id']
+        self.planidcodemapping[planid] = plan['code']
+        countries = plan['countries']
+        if not countries:
+            return
+        if is_global:
+            self.globalplanids.add(planid)
+        if len(countries) == 1:
+            self.planidswithonelocation.add(planid)
+        for country in countries:
+            countryiso = country['iso3']
+            if not countryiso:
+                continue
+            plans_by_year = self.plans_by_year_by_country.get(countryiso, {})
+            dict_of_lists_add(plans_by_year, year, plan)
+            self.plans_by_year_by_country[countryiso] = plans_by_year
 
     def call_others(self, row):
         requirements_clusters, funding_clusters, notspecified, shared = self.others['cluster'].get_requirements_funding_plan(row)
@@ -117,7 +262,9 @@ class FTS:
         if plans_by_year is None:
             logger.error(f'We have latest year funding data but no overall funding data for {title}')
         else:
-            hxl_resource = self.reqfund.generate_resource(folder, dataset, plans_by_year, country, self.call_others)
+            with self.downloader.metrics.staged('requirements_funding'):
+                hxl_resource = self.reqfund.generate_resource(folder, dataset, plans_by_year, country,
+                                                              self.call_others)
             resources.insert(0, hxl_resource)
             other_hxl_resource = self.generate_other_resources(resources, folder, dataset, country)
             if other_hxl_resource:
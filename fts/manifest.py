@@ -0,0 +1,83 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class UploadManifest:
+    '''
+    SQLite store of content hashes of what was last uploaded to HDX for each dataset: one (under the empty name) for
+    the dataset, showcase and resource metadata and one for each resource file. Comparing the hashes of a freshly
+    generated dataset with these tells whether it can be skipped, needs only some resource files uploaded or needs a
+    full update.
+    '''
+    statuses = ('skipped', 'partial', 'full')
+    # Dataset fields that change from run to run without the content changing
+    run_fields = ('dataset_date',)
+
+    def __init__(self, path):
+        self.path = path
+        self.reopen()
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes (dataset TEXT, name TEXT, hash TEXT, '
+                                'PRIMARY KEY (dataset, name))')
+        self.connection.commit()
+        self.counts = {status: 0 for status in self.statuses}
+
+    def reopen(self):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+
+    @staticmethod
+    def hash_file(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @classmethod
+    def get_hashes(cls, dataset, showcase):
+        resources = dataset.get_resources()
+        metadata = {
+            'dataset': {key: value for key, value in dataset.data.items()
+                        if key != 'resources' and key not in cls.run_fields},
+            'showcase': showcase.data,
+            'resources': [resource.data for resource in resources]
+        }
+        metadata = json.dumps(metadata, sort_keys=True, default=str).encode('utf-8')
+        hashes = {'': hashlib.sha256(metadata).hexdigest()}
+        for resource in resources:
+            hashes[resource['name']] = cls.hash_file(resource.get_file_to_upload())
+        return hashes
+
+    def compare(self, name, hashes):
+        '''
+        Compare hashes with those stored for dataset name. Returns a tuple of the status (skipped, partial or full)
+        and the names of the resources whose files have changed.
+        '''
+        with self.lock:
+            previous = dict(self.connection.execute('SELECT name, hash FROM hashes WHERE dataset=?', (name,)))
+        if previous == hashes:
+            return 'skipped', list()
+        if previous.get('') != hashes[''] or previous.keys() != hashes.keys():
+            return 'full', [resourcename for resourcename in hashes if resourcename]
+        return 'partial', [resourcename for resourcename in hashes if previous[resourcename] != hashes[resourcename]]
+
+    def store(self, name, hashes):
+        with self.lock:
+            self.connection.execute('DELETE FROM hashes WHERE dataset=?', (name,))
+            self.connection.executemany('INSERT INTO hashes VALUES (?, ?, ?)',
+                                        [(name, resourcename, value) for resourcename, value in hashes.items()])
+            self.connection.commit()
+
+    def record(self, status):
+        with self.lock:
+            self.counts[status] += 1
+
+    def close(self):
+        logger.info(f'Datasets skipped: {self.counts["skipped"]}, partially updated: {self.counts["partial"]}, '
+                    f'fully updated: {self.counts["full"]}')
+        self.connection.close()
@@ -0,0 +1,209 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+class RunMetrics:
+    '''
+    Counts and timings of FTS requests grouped by the stage of the run that issued them and the endpoint template
+    requested, along with per country generation and CSV writing times. The current stage and country are thread
+    local as independent stages can run at the same time. Work handed to other threads carries them over with
+    get_context and within.
+    '''
+    endpoints = [(re.compile(r'plan.overview.progress'), 'plan overview'),
+                 (re.compile(r'summary.trends'), 'trends'),
+                 (re.compile(r'public.location'), 'location'),
+                 (re.compile(r'groupby.(\w+)'), 'custom-search groupby {}'),
+                 (re.compile(r'custom.search'), 'flows page')]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.requests = dict()
+        self.countries = dict()
+        self.rate = None
+
+    @classmethod
+    def get_endpoint(cls, url):
+        for pattern, endpoint in cls.endpoints:
+            match = pattern.search(url)
+            if match:
+                return endpoint.format(*match.groups())
+        return 'other'
+
+    @property
+    def stage(self):
+        return getattr(self.local, 'stage', 'other')
+
+    @property
+    def country(self):
+        return getattr(self.local, 'country', None)
+
+    @contextmanager
+    def staged(self, stage):
+        previous = self.stage
+        self.local.stage = stage
+        try:
+            yield
+        finally:
+            self.local.stage = previous
+
+    def get_context(self):
+        return self.stage, self.country
+
+    @contextmanager
+    def within(self, context):
+        '''
+        Record as the stage and country in context, from get_context on the thread that handed over the work.
+        '''
+        previous = self.get_context()
+        self.local.stage, self.local.country = context
+        try:
+            yield
+        finally:
+            self.local.stage, self.local.country = previous
+
+    def record_request(self, url, seconds, size=0, status=200, cache_hit=False, retries=0, throttles=0):
+        key = self.stage, self.get_endpoint(url)
+        with self.lock:
+            stats = self.requests.get(key)
+            if stats is None:
+                stats = {'count': 0, 'seconds': 0, 'max_seconds': 0, 'bytes': 0, 'cache_hits': 0, 'retries': 0,
+                         'throttles': 0, 'statuses': dict()}
+                self.requests[key] = stats
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes'] += size
+            if cache_hit:
+                stats['cache_hits'] += 1
+            stats['retries'] += retries
+            stats['throttles'] += throttles
+            status = str(status)
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+        if self.country is not None:
+            self.add_country_time(self.country, 'requests', 1)
+
+    def set_rate(self, rate):
+        '''
+        Set the current request rate of the adaptive rate limiter in calls per period.
+        '''
+        self.rate = rate
+
+    def add_country_time(self, countryiso, name, seconds):
+        with self.lock:
+            times = self.countries.get(countryiso)
+            if times is None:
+                times = {'seconds': 0, 'csv_seconds': 0}
+                self.countries[countryiso] = times
+            times[name] = times.get(name, 0) + seconds
+
+    @contextmanager
+    def timed_country(self, countryiso):
+        self.local.country = countryiso
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_country_time(countryiso, 'seconds', time.perf_counter() - start)
+            self.local.country = None
+
+    @contextmanager
+    def timed_csv(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.country is not None:
+                self.add_country_time(self.country, 'csv_seconds', time.perf_counter() - start)
+
+    def drain(self):
+        '''
+        Return what has been recorded so far and start again, for passing from a worker process to the parent.
+        '''
+        with self.lock:
+            data = self.requests, self.countries
+            self.requests = dict()
+            self.countries = dict()
+        return data
+
+    def merge(self, data):
+        requests, countries = data
+        with self.lock:
+            for key, other in requests.items():
+                stats = self.requests.get(key)
+                if stats is None:
+                    self.requests[key] = other
+                    continue
+                for name in ('count', 'seconds', 'bytes', 'cache_hits', 'retries', 'throttles'):
+                    stats[name] += other[name]
+                stats['max_seconds'] = max(stats['max_seconds'], other['max_seconds'])
+                for status, count in other['statuses'].items():
+                    stats['statuses'][status] = stats['statuses'].get(status, 0) + count
+        for countryiso, times in countries.items():
+            for name, seconds in times.items():
+                self.add_country_time(countryiso, name, seconds)
+
+    def get_report(self, timings=None, graph=None):
+        requests = list()
+        totals = {'count': 0, 'seconds': 0, 'bytes': 0, 'cache_hits': 0, 'retries': 0, 'throttles': 0}
+        for (stage, endpoint), stats in sorted(self.requests.items()):
+            requests.append({'stage': stage, 'endpoint': endpoint, **stats})
+            for name in totals:
+                totals[name] += stats[name]
+        return {'requests': requests, 'totals': totals, 'stages': timings or dict(), 'countries': self.countries,
+                'rate': self.rate, 'graph': graph or dict()}
+
+    def save(self, path, timings=None, graph=None):
+        with open(path, 'w') as f:
+            json.dump(self.get_report(timings, graph), f, indent=2, sort_keys=True)
+
+    def get_prometheus(self, timings=None, graph=None):
+        lines = list()
+
+        def add_metric(name, kind, description, samples):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                labels = ','.join(f'{label}="{labelvalue}"' for label, labelvalue in labels.items())
+                lines.append(f'{name}{{{labels}}} {value}')
+
+        samples = dict()
+        for (stage, endpoint), stats in sorted(self.requests.items()):
+            labels = {'stage': stage, 'endpoint': endpoint}
+            for status, count in sorted(stats['statuses'].items()):
+                samples.setdefault('requests', list()).append(({**labels, 'status': status}, count))
+            samples.setdefault('seconds', list()).append((labels, stats['seconds']))
+            samples.setdefault('bytes', list()).append((labels, stats['bytes']))
+            samples.setdefault('cache_hits', list()).append((labels, stats['cache_hits']))
+            samples.setdefault('retries', list()).append((labels, stats['retries']))
+            samples.setdefault('throttles', list()).append((labels, stats['throttles']))
+        add_metric('fts_requests_total', 'counter', 'FTS requests made.', samples.get('requests', list()))
+        add_metric('fts_request_seconds_total', 'counter', 'Time spent on FTS requests.',
+                   samples.get('seconds', list()))
+        add_metric('fts_response_bytes_total', 'counter', 'Size of FTS responses.', samples.get('bytes', list()))
+        add_metric('fts_cache_hits_total', 'counter', 'FTS requests served from the cache.',
+                   samples.get('cache_hits', list()))
+        add_metric('fts_retries_total', 'counter', 'FTS requests retried.', samples.get('retries', list()))
+        add_metric('fts_throttles_total', 'counter', 'FTS requests throttled with 429 or 503.',
+                   samples.get('throttles', list()))
+        if self.rate is not None:
+            add_metric('fts_request_rate', 'gauge', 'Current FTS request rate in calls per rate limit period.',
+                       [(dict(), self.rate)])
+        add_metric('fts_stage_seconds', 'gauge', 'Time taken by each stage of setting up.',
+                   [({'stage': stage}, seconds) for stage, seconds in sorted((timings or dict()).items())])
+        if graph:
+            add_metric('fts_critical_path_seconds', 'gauge', 'Time taken by the longest chain of dependent stages.',
+                       [({'path': '>'.join(graph['critical_path'])}, graph['critical_path_seconds'])])
+        countries = sorted(self.countries.items())
+        add_metric('fts_country_seconds', 'gauge', 'Time taken to generate each country dataset.',
+                   [({'country': countryiso}, times['seconds']) for countryiso, times in countries])
+        add_metric('fts_country_csv_seconds', 'gauge', 'Time taken to write the CSVs of each country dataset.',
+                   [({'country': countryiso}, times['csv_seconds']) for countryiso, times in countries])
+        return '\n'.join(lines) + '\n'
+
+    def save_prometheus(self, path, timings=None, graph=None):
+        with open(path, 'w') as f:
+            f.write(self.get_prometheus(timings, graph))
@@ -0,0 +1,40 @@
+import pickle
+from io import BytesIO
+from os import pread
+from tempfile import TemporaryFile
+
+
+class FlowPartitions:
+    '''
+    Flows partitioned by country on disk, one temporary file per country, so that a global sweep of a year's flows
+    does not need to be held in memory. Flows for a country come back in the order they were added. Reading uses
+    pread so that forked worker processes sharing the files do not move each other's file positions.
+    '''
+    def __init__(self, folder=None):
+        self.folder = folder
+        self.files = dict()
+        self.counts = dict()
+
+    def add(self, countryiso, flow):
+        file = self.files.get(countryiso)
+        if file is None:
+            file = TemporaryFile(dir=self.folder)
+            self.files[countryiso] = file
+            self.counts[countryiso] = 0
+        pickle.dump(flow, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.counts[countryiso] += 1
+
+    def get(self, countryiso):
+        file = self.files.get(countryiso)
+        if file is None:
+            return
+        file.flush()
+        data = BytesIO(pread(file.fileno(), file.tell(), 0))
+        for _ in range(self.counts[countryiso]):
+            yield pickle.load(data)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = dict()
+        self.counts = dict()
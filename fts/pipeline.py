@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+from collections import deque
+from os import getenv
+from os.path import exists, join
+from queue import Queue
+
+from hdx.utilities.loader import load_file_to_str
+from hdx.utilities.path import get_wheretostart
+from hdx.utilities.saver import save_str_to_file
+
+logger = logging.getLogger(__name__)
+
+
+class UploadPipeline:
+    '''
+    Overlaps generating datasets with uploading them to HDX. Generation runs on the calling thread and hands each
+    finished item to a queue of at most maxsize items served by upload worker threads, blocking while the queue is
+    full. A failed upload is retried up to retries times with exponential backoff. Progress is checkpointed in order:
+    progress.txt (in the format used by progress_storing_folder) always names the earliest item whose upload has not
+    finished, so a resumed run never skips an item that was generated but not uploaded.
+    '''
+    def __init__(self, info, upload, key='iso3', workers=2, maxsize=4, retries=3, backoff=5):
+        self.info = info
+        self.upload = upload
+        self.key = key
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.progress_file = join(info['folder'], 'progress.txt')
+        self.queue = Queue(maxsize)
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.uploaded = set()
+        self.errors = list()
+
+    def get_wheretostart(self):
+        contents = getenv('WHERETOSTART')
+        message = 'Environment variable'
+        if not contents:
+            if not exists(self.progress_file):
+                return None
+            contents = load_file_to_str(self.progress_file, strip=True)
+            message = 'File'
+        return get_wheretostart(contents, message, self.key)
+
+    def checkpoint(self):
+        while self.pending and self.pending[0] in self.uploaded:
+            self.uploaded.remove(self.pending.popleft())
+        if self.pending:
+            output = f'{self.key}={self.pending[0]}'
+            self.info['progress'] = output
+            save_str_to_file(output, self.progress_file)
+
+    def started(self, current):
+        with self.lock:
+            self.pending.append(current)
+            self.checkpoint()
+
+    def finished(self, current):
+        with self.lock:
+            self.uploaded.add(current)
+            self.checkpoint()
+
+    def upload_item(self, current, item):
+        for attempt in range(self.retries + 1):
+            try:
+                self.upload(self.info, *item)
+                self.finished(current)
+                return
+            except Exception as ex:
+                if attempt == self.retries:
+                    logger.exception(f'Upload of {current} failed after {attempt + 1} attempts!')
+                    with self.lock:
+                        self.errors.append(ex)
+                    return
+                wait = self.backoff * 2 ** attempt
+                logger.warning(f'Upload of {current} failed ({ex}), retrying in {wait}s')
+                time.sleep(wait)
+
+    def worker(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            self.upload_item(*entry)
+
+    def run(self, iterator, generate):
+        '''
+        Call generate(info, nextdict) for each dictionary in iterator not skipped by WHERETOSTART. If it returns
+        a tuple, the tuple is queued to be uploaded by calling upload(info, *tuple). If it returns None, there is
+        nothing to upload. Raises the first upload error once the queue has drained.
+        '''
+        wheretostart = self.get_wheretostart()
+        found = wheretostart is None
+        threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for nextdict in iterator:
+                current = nextdict[self.key]
+                if not found:
+                    if current != wheretostart:
+                        continue
+                    found = True
+                    logger.info(f'Starting run from WHERETOSTART {wheretostart}')
+                if self.errors:
+                    break
+                self.started(current)
+                item = generate(self.info, nextdict)
+                if item is None:
+                    self.finished(current)
+                else:
+                    self.queue.put((current, item))
+        finally:
+            for _ in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+        if self.errors:
+            raise self.errors[0]
@@ -0,0 +1,64 @@
+import json
+import logging
+import sqlite3
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class PlanIndex:
+    '''
+    SQLite snapshot of the plans of each year with the per country requirements and funding already worked out, so
+    that years which can no longer change do not need their plan overview and per plan location breakdowns
+    downloading again. Years after the current year less refresh_years are always downloaded. Plans are stored as
+    compressed JSON. The snapshot is discarded if it was written by a different version of the index.
+    '''
+    version = 3
+
+    def __init__(self, path, today, refresh_years=2):
+        self.first_open_year = today.year - refresh_years + 1
+        self.path = path
+        # Used from whichever thread runs the plans stage
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS plans (year INTEGER, position INTEGER, planid INTEGER, '
+                                'isglobal INTEGER, plan BLOB, PRIMARY KEY (year, position))')
+        result = self.connection.execute('SELECT value FROM meta WHERE key=?', ('version',)).fetchone()
+        if result is None or int(result[0]) != self.version:
+            if result is not None:
+                logger.info(f'Discarding plan index snapshot of version {result[0]}')
+            self.connection.execute('DELETE FROM plans')
+            self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('version', str(self.version)))
+        self.connection.commit()
+
+    def is_closed(self, year):
+        return year < self.first_open_year
+
+    def load(self, year):
+        '''
+        Get a list of (plan, isglobal) for year from the snapshot or None if the year is open or not in the snapshot.
+        '''
+        if not self.is_closed(year):
+            return None
+        rows = self.connection.execute('SELECT isglobal, plan FROM plans WHERE year=? ORDER BY position',
+                                       (year,)).fetchall()
+        if not rows:
+            return None
+        return [(json.loads(zlib.decompress(plan)), bool(isglobal)) for isglobal, plan in rows]
+
+    def store(self, year, plans):
+        '''
+        Store plans, a list of (plan, isglobal), for year if the year is closed.
+        '''
+        if not self.is_closed(year) or not plans:
+            return
+        cursor = self.connection.cursor()
+        cursor.execute('DELETE FROM plans WHERE year=?', (year,))
+        for position, (plan, isglobal) in enumerate(plans):
+            data = zlib.compress(json.dumps(plan, separators=(',', ':')).encode('utf-8'))
+            cursor.execute('INSERT INTO plans VALUES (?, ?, ?, ?, ?)', (year, position, plan['id'], int(isglobal),
+                                                                       data))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
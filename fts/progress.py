@@ -0,0 +1,27 @@
+from os.path import exists, join
+
+
+class CountryProgress:
+    '''
+    Records each completed country in the progress folder so that a run in which countries finish out of order, for
+    example when they are spread across worker processes, can be resumed by skipping the ones already done.
+    '''
+    def __init__(self, info, key='iso3'):
+        self.key = key
+        self.path = join(info['folder'], 'completed.txt')
+        self.completed = set()
+        if exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self.completed.add(line)
+
+    def remaining(self, countries):
+        return [country for country in countries if country[self.key] not in self.completed]
+
+    def complete(self, country):
+        value = country[self.key]
+        self.completed.add(value)
+        with open(self.path, 'a') as f:
+            f.write(f'{value}\n')
@@ -0,0 +1,111 @@
+import multiprocessing
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    Thread safe token bucket shared by every request made through FTSDownload so that concurrent downloads still
+    honour the API's rate limit. The bucket holds at most calls tokens and refills at calls per period seconds.
+    '''
+    def __init__(self, calls=1, period=1):
+        self.calls = calls
+        self.period = period
+        self.capacity = calls
+        self.rate = calls / period
+        self.tokens = calls
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def try_acquire(self):
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    '''
+    Token bucket whose rate follows the API's real limit: the rate rises by increase calls per second after each
+    healthy response up to max_calls per period and is multiplied by decrease when the API throttles, down to
+    min_calls per period. A Retry-After from the API holds back every request until it has passed. The rate and
+    pause are held in shared memory so that limiters got from share in forked processes adapt together.
+    '''
+    def __init__(self, calls=1, period=1, max_calls=None, min_calls=None, increase=0.05, decrease=0.5, processes=1,
+                 shared=None):
+        super().__init__(calls, period)
+        if max_calls is None:
+            max_calls = calls
+        if min_calls is None:
+            min_calls = min(calls, 1)
+        self.max_calls = max_calls
+        self.min_calls = min_calls
+        self.max_rate = max_calls / period
+        self.min_rate = min_calls / period
+        self.increase = increase
+        self.decrease = decrease
+        self.processes = processes
+        if shared is None:
+            # Rate across all processes and monotonic time until which requests are paused
+            shared = multiprocessing.Value('d', self.rate), multiprocessing.Value('d', 0)
+        self.shared = shared
+        self.shared_rate, self.shared_paused_until = shared
+        self.rate = self.shared_rate.value / processes
+        self.throttles = 0
+
+    def share(self, processes):
+        '''
+        Get a limiter for one of processes forked after this limiter was created. Each process gets an even share of
+        the rate and a throttle seen by any of them slows and pauses them all.
+        '''
+        return AdaptiveRateLimiter(self.calls, self.period, self.max_calls, self.min_calls, self.increase,
+                                   self.decrease, processes, self.shared)
+
+    def refill(self):
+        self.rate = self.shared_rate.value / self.processes
+        super().refill()
+
+    def success(self):
+        with self.lock:
+            self.refill()
+            with self.shared_rate.get_lock():
+                self.shared_rate.value = min(self.max_rate, self.shared_rate.value + self.increase)
+                self.rate = self.shared_rate.value / self.processes
+
+    def throttle(self, retry_after=None):
+        with self.lock:
+            self.refill()
+            with self.shared_rate.get_lock():
+                self.shared_rate.value = max(self.min_rate, self.shared_rate.value * self.decrease)
+                self.rate = self.shared_rate.value / self.processes
+            self.tokens = min(self.tokens, 0)
+            self.throttles += 1
+            if retry_after:
+                with self.shared_paused_until.get_lock():
+                    self.shared_paused_until.value = max(self.shared_paused_until.value,
+                                                         time.monotonic() + retry_after)
+
+    def acquire(self):
+        while True:
+            wait = self.shared_paused_until.value - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        super().acquire()
@@ -6,11 +6,28 @@ logger = logging.getLogger(__name__)
 
 
 class RequirementsFunding:
-    def __init__(self, downloader, locations, globalplanids, today):
+    def __init__(self, downloader, locations, globalplanids, today, export=None):
         self.downloader = downloader
         self.locations = locations
         self.globalplanids = globalplanids
         self.today = today
+        self.export = export
+        self.location_breakdowns = dict()
+        self.funding_by_year_by_country = dict()
+
+    def download_location_breakdowns(self, plans_by_year):
+        planids = dict()
+        for plans in plans_by_year.values():
+            for plan in plans:
+                countries = plan['countries']
+                if not countries or len(countries) == 1:
+                    continue
+                if plan.get('customLocationCode') == 'COVD':
+                    continue
+                planids[plan['id']] = None
+        planids = list(planids.keys())
+        partial_urls = [f'1/fts/flow/custom-search?planid={planid}&groupby=location' for planid in planids]
+        self.location_breakdowns = dict(zip(planids, self.downloader.download_batch(partial_urls)))
 
     def add_country_requirements_funding(self, planid, plan, countries):
         if len(countries) == 1:
@@ -31,8 +48,9 @@ class RequirementsFunding:
         else:
             if plan.get('customLocationCode') == 'COVD':
                 return True
-            funding_url = f'1/fts/flow/custom-search?planid={planid}&groupby=location'
-            data = self.downloader.download(funding_url)
+            data = self.location_breakdowns.get(planid)
+            if data is None:
+                data = self.downloader.download(f'1/fts/flow/custom-search?planid={planid}&groupby=location')
             requirements = data.get('requirements')
             country_requirements = dict()
             if requirements is not None:
@@ -66,17 +84,40 @@ class RequirementsFunding:
                     country['percentFunded'] = int(funding / requirements * 100 + 0.5)
         return False
 
-    def get_country_funding(self, countryid, plans_by_year, start_year=2010):
-        funding_by_year = dict()
+    def get_trends_urls(self, countryid, plans_by_year, start_year=2010):
         if plans_by_year is not None:
             start_year = sorted(plans_by_year.keys())[0]
-        for year in range(self.today.year + 5, start_year - 5, -11):
-            data = self.downloader.download(f'2/country/{countryid}/summary/trends/{year}')
-            for object in data:
-                year = object['year']
-                funding = object['totalFunding']
-                if funding:
-                    funding_by_year[year] = funding
+        return [f'2/country/{countryid}/summary/trends/{year}' for year in range(self.today.year + 5, start_year - 5, -11)]
+
+    @staticmethod
+    def add_trends(funding_by_year, data):
+        for object in data:
+            year = object['year']
+            funding = object['totalFunding']
+            if funding:
+                funding_by_year[year] = funding
+
+    def precompute_country_funding(self, countries, plans_by_year_by_country):
+        countryids = list()
+        partial_urls = list()
+        for country in countries:
+            countryid = country['id']
+            for partial_url in self.get_trends_urls(countryid, plans_by_year_by_country.get(country['iso3'])):
+                countryids.append(countryid)
+                partial_urls.append(partial_url)
+        self.funding_by_year_by_country = dict()
+        for countryid, data in zip(countryids, self.downloader.download_batch(partial_urls)):
+            funding_by_year = self.funding_by_year_by_country.get(countryid, dict())
+            self.add_trends(funding_by_year, data)
+            self.funding_by_year_by_country[countryid] = funding_by_year
+
+    def get_country_funding(self, countryid, plans_by_year, start_year=2010):
+        funding_by_year = self.funding_by_year_by_country.get(countryid)
+        if funding_by_year is not None:
+            return funding_by_year
+        funding_by_year = dict()
+        for data in self.downloader.download_batch(self.get_trends_urls(countryid, plans_by_year, start_year)):
+            self.add_trends(funding_by_year, data)
         return funding_by_year
 
     def generate_resource(self, folder, dataset, plans_by_year, country, call_others=lambda x: None):
@@ -135,5 +176,10 @@ class RequirementsFunding:
             'description': f'FTS Annual Requirements and Funding Data for {countryname}',
             'format': 'csv'
         }
-        success, results = dataset.generate_resource_from_iterator(headers, rows, hxl_names, folder, filename, resourcedata)
+        with self.downloader.metrics.timed_csv():
+            success, results = dataset.generate_resource_from_iterator(headers, rows, hxl_names, folder, filename,
+                                                                       resourcedata)
+        if self.export is not None:
+            self.export.add_rows('requirements_funding', countryiso, rows)
+            self.export.write('requirements_funding', countryiso)
         return results['resource']
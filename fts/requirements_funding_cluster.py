@@ -1,27 +1,46 @@
-import copy
 import logging
+from operator import itemgetter
 
 from hdx.utilities.downloader import DownloadError
 
-from fts.helpers import hxl_names
+from fts.helpers import hxl_names, generate_resource_from_iterator
 
 logger = logging.getLogger(__name__)
 
+# Rows are tuples in the order of these columns, the first 7 of which come from the requirements and funding row
+columns = ('countryCode', 'id', 'name', 'code', 'startDate', 'endDate', 'year', 'clusterCode', 'cluster',
+           'requirements', 'funding', 'percentFunded')
+get_base_row = itemgetter(*columns[:7])
+get_cluster = itemgetter(columns.index('cluster'))
+
 
 class RequirementsFundingCluster:
-    def __init__(self, downloader, planidswithonelocation, clusterlevel=''):
+    def __init__(self, downloader, planidswithonelocation, clusterlevel='', export=None):
         self.downloader = downloader
         self.planidswithonelocation = planidswithonelocation
         self.clusterlevel = clusterlevel
+        self.export = export
         self.rows = list()
+        self.breakdowns = dict()
 
-    def get_requirements_funding_plan(self, inrow):
-        planid = inrow['id']
-        try:
-            data = self.downloader.download(f'1/fts/flow/custom-search?planid={planid}&groupby={self.clusterlevel}cluster')
-        except DownloadError:
-            logger.error(f'Problem with downloading cluster data for {planid}!')
-            return None, None, None, None
+    def get_url(self, planid):
+        return f'1/fts/flow/custom-search?planid={planid}&groupby={self.clusterlevel}cluster'
+
+    def prefetch_breakdowns(self, planids):
+        planids = sorted(planid for planid in planids if planid not in self.breakdowns)
+        results = self.downloader.download_batch([self.get_url(planid) for planid in planids], return_exceptions=True)
+        for planid, data in zip(planids, results):
+            if isinstance(data, DownloadError):
+                logger.error(f'Problem with downloading cluster data for {planid}!')
+                self.breakdowns[planid] = None, None, None, None
+            elif isinstance(data, Exception):
+                raise data
+            else:
+                self.breakdowns[planid] = self.parse_breakdown(planid, data)
+        logger.info(f'Prefetched {self.clusterlevel}cluster breakdowns for {len(planids)} plans')
+
+    @staticmethod
+    def parse_breakdown(planid, data):
         requirements_clusters = dict()
         for reqobject in data['requirements']['objects']:
             requirements = reqobject.get('revisedRequirements')
@@ -48,15 +67,27 @@ class RequirementsFundingCluster:
             shared = fund_objects[0]['totalBreakdown']['sharedFunding']
         return requirements_clusters, funding_clusters, notspecified, shared
 
+    def get_requirements_funding_plan(self, inrow):
+        planid = inrow['id']
+        if planid not in self.planidswithonelocation:
+            # Only plans with one location are broken down by cluster
+            return None, None, None, None
+        breakdown = self.breakdowns.get(planid)
+        if breakdown is not None:
+            return breakdown
+        try:
+            data = self.downloader.download(self.get_url(planid))
+        except DownloadError:
+            logger.error(f'Problem with downloading cluster data for {planid}!')
+            breakdown = None, None, None, None
+        else:
+            breakdown = self.parse_breakdown(planid, data)
+        self.breakdowns[planid] = breakdown
+        return breakdown
+
     @staticmethod
     def create_row(base_row, clusterid='', name='', requirements='', funding='', percentFunded=''):
-        row = copy.deepcopy(base_row)
-        row['clusterCode'] = clusterid
-        row['cluster'] = name
-        row['requirements'] = requirements
-        row['funding'] = funding
-        row['percentFunded'] = percentFunded
-        return row
+        return base_row + (clusterid, name, requirements, funding, percentFunded)
 
     def generate_rows_requirements_funding(self, inrow, requirements_clusters, funding_clusters, notspecified, shared):
         if requirements_clusters is None and funding_clusters is None:
@@ -64,12 +95,7 @@ class RequirementsFundingCluster:
         planid = inrow['id']
         if planid not in self.planidswithonelocation:
             return
-        base_row = copy.deepcopy(inrow)
-        del base_row['typeId']
-        del base_row['typeName']
-        del base_row['requirements']
-        del base_row['funding']
-        del base_row['percentFunded']
+        base_row = get_base_row(inrow)
         subrows = list()
         for clusterid, (fundname, funding) in funding_clusters.items():
             requirements_cluster = requirements_clusters.get(clusterid)
@@ -79,11 +105,11 @@ class RequirementsFundingCluster:
                 reqname, requirements = requirements_cluster
                 if not fundname:
                     fundname = reqname
-            row = self.create_row(base_row, clusterid, fundname, requirements, funding)
             if requirements and funding != '':
-                row['percentFunded'] = int(funding / requirements * 100 + 0.5)
+                percentFunded = int(funding / requirements * 100 + 0.5)
             else:
-                row['percentFunded'] = ''
+                percentFunded = ''
+            row = self.create_row(base_row, clusterid, fundname, requirements, funding, percentFunded)
             subrows.append(row)
 
         fundclusterids = list(funding_clusters.keys())
@@ -93,7 +119,7 @@ class RequirementsFundingCluster:
             row = self.create_row(base_row, clusterid, reqname, requirements)
             subrows.append(row)
 
-        self.rows.extend(sorted(subrows, key=lambda k: k['cluster']))
+        self.rows.extend(sorted(subrows, key=get_cluster))
 
         row = self.create_row(base_row, name='Not specified', funding=notspecified)
         self.rows.append(row)
@@ -107,7 +133,7 @@ class RequirementsFundingCluster:
     def generate_resource(self, folder, dataset, country):
         if not self.rows:
             return None
-        headers = list(self.rows[0].keys())
+        headers = list(columns)
         filename = f'fts_requirements_funding_{self.clusterlevel}cluster_{country["iso3"].lower()}.csv'
         description = f'FTS Annual Requirements and Funding Data by Cluster for {country["name"]}'
         if self.clusterlevel:
@@ -117,10 +143,12 @@ class RequirementsFundingCluster:
             'description': description,
             'format': 'csv'
         }
-        success, results = dataset.generate_resource_from_iterator(headers, self.rows, hxl_names, folder, filename,
-                                                                   resourcedata)
+        with self.downloader.metrics.timed_csv():
+            resource = generate_resource_from_iterator(dataset, headers, self.rows, hxl_names, folder, filename,
+                                                       resourcedata, dict_form=False)
+        if self.export is not None:
+            table = f'{self.clusterlevel}cluster'
+            self.export.add_rows(table, country['iso3'], self.rows)
+            self.export.write(table, country['iso3'])
         self.rows = list()
-        if success:
-            return results['resource']
-        else:
-            return None
+        return resource
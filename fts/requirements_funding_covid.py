@@ -1,14 +1,21 @@
-import copy
 import logging
+from operator import itemgetter
 
-from fts.helpers import hxl_names
+from fts.helpers import hxl_names, generate_resource_from_iterator
 
 logger = logging.getLogger(__name__)
 
+# Rows are tuples in the order of these columns, the first 11 of which come from the requirements and funding row
+columns = ('countryCode', 'id', 'name', 'code', 'typeId', 'typeName', 'startDate', 'endDate', 'year', 'requirements',
+           'funding', 'covidFunding', 'covidPercentageOfFunding')
+get_base_row = itemgetter(*columns[:11])
+
 
 class RequirementsFundingCovid:
-    def __init__(self, downloader, locations, plans_by_year_by_country):
+    def __init__(self, downloader, locations, plans_by_year_by_country, export=None):
         self.downloader = downloader
+        self.export = export
+        # COVID funding keyed by (planid, iso3)
         self.covidfundingbyplanandlocation = dict()
         self.rows = list()
         self.get_covid_funding(locations.id_to_iso3, plans_by_year_by_country)
@@ -35,15 +42,19 @@ class RequirementsFundingCovid:
                     else:
                         multiplecountry_planids[planid] = countryisos
 
-        onecountry_planids = ','.join(sorted(planid_to_country.keys()))
-        data = self.downloader.download(f'1/fts/flow/custom-search?emergencyid=911&planid={onecountry_planids}&groupby=plan')
-        for fundingobject in data['report3']['fundingTotals']['objects'][0]['objectsBreakdown']:
-            planid = fundingobject.get('id')
-            countryiso = planid_to_country[planid]
-            self.covidfundingbyplanandlocation[f'{planid}-{countryiso}'] = fundingobject['totalFunding']
+        if planid_to_country:
+            onecountry_planids = ','.join(sorted(planid_to_country.keys()))
+            data = self.downloader.download(f'1/fts/flow/custom-search?emergencyid=911&planid={onecountry_planids}&groupby=plan')
+            for fundingobject in data['report3']['fundingTotals']['objects'][0]['objectsBreakdown']:
+                planid = fundingobject.get('id')
+                countryiso = planid_to_country[planid]
+                self.covidfundingbyplanandlocation[(int(planid), countryiso)] = fundingobject['totalFunding']
 
-        for planid in multiplecountry_planids:
-            data = self.downloader.download(f'1/fts/flow/custom-search?emergencyid=911&planid={planid}&groupby=location')
+        # Custom search only groups by one of plan or location so the breakdowns of multiple country plans need a
+        # request each, which download_batch sends concurrently
+        planids = list(multiplecountry_planids.keys())
+        partial_urls = [f'1/fts/flow/custom-search?emergencyid=911&planid={planid}&groupby=location' for planid in planids]
+        for planid, data in zip(planids, self.downloader.download_batch(partial_urls)):
             fundingobjects = data['report3']['fundingTotals']['objects']
             if len(fundingobjects) == 0:
                 continue
@@ -51,35 +62,32 @@ class RequirementsFundingCovid:
                 locationid = int(fundingobject['id'])
                 countryiso = locationid_to_iso3.get(locationid)
                 if countryiso:
-                    self.covidfundingbyplanandlocation[f'{planid}-{countryiso}'] = fundingobject['totalFunding']
+                    self.covidfundingbyplanandlocation[(int(planid), countryiso)] = fundingobject['totalFunding']
 
     def generate_plan_funding(self, inrow):
         planid = inrow['id']
         countryiso = inrow['countryCode']
-        covidfunding = self.covidfundingbyplanandlocation.get(f'{planid}-{countryiso}')
+        covidfunding = self.covidfundingbyplanandlocation.get((planid, countryiso))
         if covidfunding is None:
             logger.info(f'Location {countryiso} of plan {planid} has no COVID component!')
             return
-        row = copy.deepcopy(inrow)
-        del row['percentFunded']
-        row['covidFunding'] = covidfunding
-        row['covidPercentageOfFunding'] = int(covidfunding / inrow['funding'] * 100 + 0.5)
-        self.rows.append(row)
+        self.rows.append(get_base_row(inrow) + (covidfunding, int(covidfunding / inrow['funding'] * 100 + 0.5)))
 
     def generate_resource(self, folder, dataset, country):
         if not self.rows:
             return None
-        headers = list(self.rows[0].keys())
+        headers = list(columns)
         filename = f'fts_requirements_funding_covid_{country["iso3"].lower()}.csv'
         resourcedata = {
             'name': filename,
             'description': f'FTS Annual Requirements, Funding and Covid Funding Data for {country["name"]}',
             'format': 'csv'
         }
-        success, results = dataset.generate_resource_from_iterator(headers, self.rows, hxl_names, folder, filename,
-                                                                   resourcedata)
+        with self.downloader.metrics.timed_csv():
+            resource = generate_resource_from_iterator(dataset, headers, self.rows, hxl_names, folder, filename,
+                                                       resourcedata, dict_form=False)
+        if self.export is not None:
+            self.export.add_rows('covid', country['iso3'], self.rows)
+            self.export.write('covid', country['iso3'])
         self.rows = list()
-        if success:
-            return results['resource']
-        else:
-            return None
+        return resource
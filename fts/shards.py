@@ -0,0 +1,70 @@
+import logging
+import pickle
+from os.path import exists
+
+logger = logging.getLogger(__name__)
+
+artifact_version = 2
+
+
+def parse_shard(text):
+    '''
+    Parse a shard given as index/count with the index counting from 0.
+    '''
+    index, count = (int(part) for part in text.split('/'))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'Shard {text} must be index/count with 0 <= index < count')
+    return index, count
+
+
+def assign_shards(countries, count, costs=None, key='iso3'):
+    '''
+    Split countries into count shards of similar total cost in seconds (see CountryCosts), giving each country in turn
+    from the most costly to the shard with the least cost so far. Countries without a cost are taken to cost the
+    average. The split only depends on the countries and costs so every node given the same costs, as saved in the
+    artifact, works out the same one. Each shard keeps the countries' original order.
+    '''
+    if costs is None:
+        costs = dict()
+    known = [costs[country[key]] for country in countries if country[key] in costs]
+    default = sum(known) / len(known) if known else 1
+    positions = {country[key]: i for i, country in enumerate(countries)}
+    loads = [0] * count
+    shards = [list() for _ in range(count)]
+    for country in sorted(countries, key=lambda country: (-costs.get(country[key], default), country[key])):
+        index = min(range(count), key=lambda i: (loads[i], i))
+        loads[index] += costs.get(country[key], default)
+        shards[index].append(country)
+    for index, shard in enumerate(shards):
+        shard.sort(key=lambda country: positions[country[key]])
+        logger.info(f'Shard {index} has {len(shard)} countries costing {loads[index]:.1f}s')
+    return shards
+
+
+def save_artifact(path, today, locations, fts, costs=None):
+    '''
+    Save locations, the state FTS works out before generating countries and the country costs in seconds to split
+    shards by, so that shards can load them. Freezing the costs here means shards do not depend on each node's own
+    costs file, which drift apart as each node only updates the countries it ran.
+    '''
+    artifact = {'version': artifact_version, 'today': today.strftime('%Y-%m-%d'), 'locations': locations,
+                'state': fts.get_state(), 'costs': costs if costs is not None else dict()}
+    with open(path, 'wb') as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+    logger.info(f'Saved precomputed state to {path}')
+
+
+def load_artifact(path, today):
+    '''
+    Load locations, FTS state and country costs saved by save_artifact, returning None, None, None if there is no
+    artifact for today.
+    '''
+    if not exists(path):
+        return None, None, None
+    with open(path, 'rb') as f:
+        artifact = pickle.load(f)
+    if artifact.get('version') != artifact_version or artifact['today'] != today.strftime('%Y-%m-%d'):
+        logger.warning(f'Ignoring precomputed state in {path} as it is out of date')
+        return None, None, None
+    logger.info(f'Loaded precomputed state from {path}')
+    return artifact['locations'], artifact['state'], artifact['costs']
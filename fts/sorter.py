@@ -0,0 +1,54 @@
+import heapq
+import pickle
+from tempfile import TemporaryFile
+
+
+class ExternalSorter:
+    '''
+    Sort rows by key keeping at most buffer_rows of them in memory. When the buffer is full, it is sorted and spilled
+    to a temporary file as a run. Iterating merges the runs with the remaining buffer. Equal keys keep the order in
+    which rows were added, as with sorted.
+    '''
+    def __init__(self, key, reverse=False, buffer_rows=100000, folder=None):
+        self.key = key
+        self.reverse = reverse
+        self.buffer_rows = buffer_rows
+        self.folder = folder
+        self.rows = list()
+        self.runs = list()
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.buffer_rows:
+            self.spill()
+
+    def spill(self):
+        self.rows.sort(key=self.key, reverse=self.reverse)
+        run = TemporaryFile(dir=self.folder)
+        for row in self.rows:
+            pickle.dump(row, run, protocol=pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        self.rows = list()
+
+    @staticmethod
+    def read_run(run):
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+    def __iter__(self):
+        self.rows.sort(key=self.key, reverse=self.reverse)
+        if not self.runs:
+            return iter(self.rows)
+        iterators = [self.read_run(run) for run in self.runs]
+        iterators.append(iter(self.rows))
+        return heapq.merge(*iterators, key=self.key, reverse=self.reverse)
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = list()
+        self.rows = list()
@@ -10,17 +10,30 @@ that register datasets in HDX.
 '''
 import argparse
 import logging
+import multiprocessing
+from functools import partial
 from datetime import datetime
 from os.path import join, expanduser
 
+from hdx.data.dataset import Dataset
 from hdx.hdx_configuration import Configuration
 from hdx.utilities.dateparse import parse_date
 from hdx.utilities.downloader import Download
-from hdx.utilities.path import progress_storing_tempdir
+from hdx.utilities.path import progress_storing_tempdir, wheretostart_tempdir_batch
 
+from fts.archive import ResponseArchive
+from fts.cache import ResponseCache
+from fts.columnar import ColumnarExport
+from fts.costs import CountryCosts
 from fts.download import FTSDownload
+from fts.flowstore import FlowStore
 from fts.locations import Locations
 from fts.main import FTS
+from fts.manifest import UploadManifest
+from fts.pipeline import UploadPipeline
+from fts.planindex import PlanIndex
+from fts.progress import CountryProgress
+from fts.shards import assign_shards, load_artifact, parse_shard, save_artifact
 
 from hdx.facades.simple import facade
 
@@ -35,51 +48,238 @@ def parse_args():
     parser.add_argument('-c', '--countries', default=None, help='Countries to run')
     parser.add_argument('-y', '--years', default=None, help='Years to run')
     parser.add_argument('-t', '--testfolder', default=None, help='Output test data to folder')
+    parser.add_argument('-a', '--archive', default=None, help='Record FTS responses in this archive file')
+    parser.add_argument('-e', '--replay', action='store_true', help='Replay FTS responses from the archive')
+    parser.add_argument('-r', '--requests', default=1, type=int, help='Number of concurrent requests to FTS')
+    parser.add_argument('-k', '--cache', default=None, help='Cache FTS responses in this database file')
+    parser.add_argument('-f', '--flowstore', default=None, help='Harvest flows incrementally into this database file')
+    parser.add_argument('-w', '--workers', default=1, type=int, help='Number of processes generating country datasets')
+    parser.add_argument('-m', '--manifest', default=None, help='Skip uploading content unchanged since the last run recorded in this database file')
+    parser.add_argument('-x', '--metrics', default=None, help='Write a JSON report of requests and timings to this file')
+    parser.add_argument('-p', '--prometheus', default=None, help='Write requests and timings as Prometheus text to this file')
+    parser.add_argument('-q', '--parquet', default=None, help='Also export flows and requirements and funding as Parquet to this folder')
+    parser.add_argument('-i', '--planindex', default=None, help='Keep a snapshot of closed years\' plans in this database file')
+    parser.add_argument('-g', '--global-flows', action='store_true', help='Get flows in one global sweep instead of per country')
+    parser.add_argument('-s', '--shard', default=None, help='Only run shard index/count of the countries, index from 0')
+    parser.add_argument('-o', '--costs', default=None, help='Keep country costs from run to run in this file for scheduling and sharding')
+    parser.add_argument('-z', '--artifact', default=None, help='Load precomputed locations and plans from this file or save them to it')
+    parser.add_argument('-n', '--precompute', action='store_true', help='Only precompute and save the artifact')
+    parser.add_argument('-j', '--stage-workers', default=1, type=int, help='Run up to this many independent setup stages at once')
+    parser.add_argument('-u', '--uploaders', default=0, type=int, help='Upload to HDX on this many threads while generating')
     args = parser.parse_args()
+    if args.shard and not args.artifact:
+        parser.error('--shard needs --artifact so that every shard splits the same countries by the same costs')
     return args
 
 
+def generate_country(fts, info, country):
+    with fts.downloader.metrics.timed_country(country['iso3']):
+        dataset, showcase, hxl_resource, ordered_resource_names = fts.generate_dataset_and_showcase(info['folder'],
+                                                                                                    country)
+    if dataset is None:
+        return None
+    return dataset, showcase, hxl_resource, ordered_resource_names
+
+
+def update_resources(dataset, names):
+    existing = Dataset.read_from_hdx(dataset['name'])
+    if existing is None:
+        return False
+    existing_resources = {resource['name']: resource for resource in existing.get_resources()}
+    if any(name not in existing_resources for name in names):
+        return False
+    for resource in dataset.get_resources():
+        if resource['name'] in names:
+            resource['id'] = existing_resources[resource['name']]['id']
+            resource['package_id'] = existing['id']
+            resource.update_in_hdx()
+    return True
+
+
+def upload_country(manifest, info, dataset, showcase, hxl_resource, ordered_resource_names):
+    dataset.update_from_yaml()
+    if hxl_resource is None:
+        dataset.preview_off()
+    else:
+        dataset.set_quickchart_resource(hxl_resource)
+    if manifest is None:
+        status = 'full'
+    else:
+        hashes = manifest.get_hashes(dataset, showcase)
+        status, names = manifest.compare(dataset['name'], hashes)
+        if status == 'skipped':
+            logger.info(f'{dataset["name"]} is unchanged, skipping upload')
+        elif status == 'partial':
+            logger.info(f'{dataset["name"]} has changed resources {", ".join(names)}')
+            if not update_resources(dataset, names):
+                status = 'full'
+    if status == 'full':
+        dataset.create_in_hdx(remove_additional_resources=True, hxl_update=False,
+                              updated_by_script='HDX Scraper: FTS', batch=info['batch'])
+        if hxl_resource and 'cluster' not in hxl_resource['name']:
+            hxl_update = True
+        else:
+            hxl_update = False
+        sorted_resources = sorted(dataset.get_resources(), key=lambda x: ordered_resource_names.index(x['name']))
+        dataset.reorder_resources([x['id'] for x in sorted_resources], hxl_update=hxl_update)
+        if hxl_resource and not hxl_update:
+            dataset.generate_resource_view()
+        showcase.create_in_hdx()
+        showcase.add_dataset(dataset)
+    if manifest is not None:
+        if status != 'skipped':
+            manifest.store(dataset['name'], hashes)
+        manifest.record(status)
+    return status
+
+
+def process_country(fts, info, country, manifest=None):
+    generated = generate_country(fts, info, country)
+    if generated is None:
+        return None
+    return upload_country(manifest, info, *generated)
+
+
+worker = dict()
+
+
+def setup_worker(fts, info, processes, manifest):
+    # Forked from the parent after FTS is set up so plans, mappings and locations are shared copy on write
+    fts.after_fork(processes)
+    fts.downloader.metrics.drain()
+    if manifest is not None:
+        manifest.reopen()
+    Configuration.read().setup_remoteckan()
+    worker['fts'] = fts
+    worker['info'] = info
+    worker['manifest'] = manifest
+
+
+def run_worker(country):
+    status = process_country(worker['fts'], worker['info'], country, worker['manifest'])
+    return country, status, worker['fts'].downloader.metrics.drain()
+
+
+def run_pool(fts, countries, processes, manifest=None):
+    with wheretostart_tempdir_batch('FTS') as info:
+        progress = CountryProgress(info)
+        remaining = progress.remaining(countries)
+        logger.info(f'Processing {len(remaining)} countries with {processes} worker processes')
+        context = multiprocessing.get_context('fork')
+        initargs = (fts, info, processes, manifest)
+        with context.Pool(processes, initializer=setup_worker, initargs=initargs) as pool:
+            # One country at a time so that, with the most expensive first, idle workers fill up with small ones
+            for country, status, metrics in pool.imap_unordered(run_worker, remaining, chunksize=1):
+                fts.downloader.metrics.merge(metrics)
+                if manifest is not None and status is not None:
+                    manifest.record(status)
+                progress.complete(country)
+
+
+def run_pipeline(fts, countries, configuration, uploaders, manifest=None):
+    with wheretostart_tempdir_batch('FTS') as info:
+        pipeline = UploadPipeline(info, partial(upload_country, manifest), workers=uploaders,
+                                  maxsize=configuration['upload_queue_size'], retries=configuration['upload_retries'],
+                                  backoff=configuration['upload_backoff'])
+        pipeline.run(countries, lambda info, country: generate_country(fts, info, country))
+
+
 def main():
     '''Generate dataset and create it in HDX'''
 
-    with Download(fail_on_missing_file=False, extra_params_yaml=join(expanduser('~'), '.extraparams.yml'), extra_params_lookup=lookup, rate_limit={'calls': 1, 'period': 1}) as downloader:
+    def get_downloader():
+        return Download(fail_on_missing_file=False, extra_params_yaml=join(expanduser('~'), '.extraparams.yml'), extra_params_lookup=lookup)
+
+    with get_downloader() as downloader:
         args = parse_args()
         configuration = Configuration.read()
-        ftsdownloader = FTSDownload(configuration, downloader, countryisos=args.countries, years=args.years, testfolder=args.testfolder)
         notes = configuration['notes']
         if args.today:
             today = parse_date(args.today)
         else:
             today = datetime.now()
+        if args.cache:
+            cache = ResponseCache(args.cache, configuration['cache_ttls'], configuration.get('cache_max_size'), today)
+        else:
+            cache = None
+        if args.archive:
+            archive = ResponseArchive(args.archive)
+        else:
+            archive = None
+        ftsdownloader = FTSDownload(configuration, downloader, countryisos=args.countries, years=args.years, testfolder=args.testfolder,
+                                    rate_limit=configuration.get('rate_limit'), concurrency=args.requests, downloader_factory=get_downloader,
+                                    cache=cache, retries=configuration['retries'], retry_backoff=configuration['retry_backoff'],
+                                    archive=archive, replay=args.replay)
 
-        locations = Locations(ftsdownloader)
-        logger.info('Number of country datasets to upload: %d' % len(locations.countries))
-
-        fts = FTS(ftsdownloader, locations, today, notes)
-        for info, country in progress_storing_tempdir('FTS', locations.countries, 'iso3'):
-            folder = info['folder']
-# for testing specific countries only
-#             if country['iso3'] not in ['AFG', 'JOR', 'TUR', 'PHL', 'SDN', 'PSE']:
-#                 continue
-            dataset, showcase, hxl_resource, ordered_resource_names = fts.generate_dataset_and_showcase(folder, country)
-            if dataset is not None:
-                dataset.update_from_yaml()
-                if hxl_resource is None:
-                    dataset.preview_off()
-                else:
-                    dataset.set_quickchart_resource(hxl_resource)
-                dataset.create_in_hdx(remove_additional_resources=True, hxl_update=False,
-                                      updated_by_script='HDX Scraper: FTS', batch=info['batch'])
-                if hxl_resource and 'cluster' not in hxl_resource['name']:
-                    hxl_update = True
-                else:
-                    hxl_update = False
-                sorted_resources = sorted(dataset.get_resources(), key=lambda x: ordered_resource_names.index(x['name']))
-                dataset.reorder_resources([x['id'] for x in sorted_resources], hxl_update=hxl_update)
-                if hxl_resource and not hxl_update:
-                    dataset.generate_resource_view()
-                showcase.create_in_hdx()
-                showcase.add_dataset(dataset)
+        if args.flowstore:
+            flowstore = FlowStore(args.flowstore, configuration['flows_updated_since_parameter'],
+                                  configuration['flows_reconcile_days'], today)
+        else:
+            flowstore = None
+
+        if args.planindex:
+            planindex = PlanIndex(args.planindex, today, configuration['plan_index_refresh_years'])
+        else:
+            planindex = None
+
+        locations = None
+        state = None
+        shard_costs = None
+        if args.artifact and not args.precompute:
+            locations, state, shard_costs = load_artifact(args.artifact, today)
+            if args.shard and state is None:
+                raise ValueError(f'Shard {args.shard} needs a precomputed artifact for today in {args.artifact}')
+        if locations is None:
+            with ftsdownloader.metrics.staged('locations'):
+                locations = Locations(ftsdownloader)
+        if args.parquet:
+            export = ColumnarExport(args.parquet)
+        else:
+            export = None
+        fts = FTS(ftsdownloader, locations, today, notes, flowstore=flowstore,
+                  sort_buffer_rows=configuration['sort_buffer_rows'], export=export, global_flows=args.global_flows,
+                  planindex=planindex, state=state, stage_workers=args.stage_workers)
+        costs = CountryCosts(args.costs)
+        plan_counts = {countryiso: sum(len(plans) for plans in plans_by_year.values())
+                       for countryiso, plans_by_year in fts.plans_by_year_by_country.items()}
+        countries = locations.countries
+        if args.artifact and state is None:
+            save_artifact(args.artifact, today, locations, fts, costs.get_seconds(countries, plan_counts))
+        if args.precompute:
+            countries = list()
+        elif args.shard:
+            index, count = parse_shard(args.shard)
+            countries = assign_shards(countries, count, shard_costs)[index]
+        logger.info('Number of country datasets to upload: %d' % len(countries))
+        if args.manifest:
+            manifest = UploadManifest(args.manifest)
+        else:
+            manifest = None
+        if args.workers > 1:
+            run_pool(fts, costs.order(countries, plan_counts), args.workers, manifest)
+        elif args.uploaders > 0:
+            run_pipeline(fts, countries, configuration, args.uploaders, manifest)
+        else:
+            for info, country in progress_storing_tempdir('FTS', countries, 'iso3'):
+                process_country(fts, info, country, manifest)
+        ftsdownloader.close()
+        if flowstore is not None:
+            flowstore.close()
+        if fts.flows.partitions is not None:
+            fts.flows.partitions.close()
+        if planindex is not None:
+            planindex.close()
+        if archive is not None:
+            archive.close()
+        if manifest is not None:
+            manifest.close()
+        if args.costs:
+            costs.update(ftsdownloader.metrics.countries)
+            costs.save()
+        if args.metrics:
+            ftsdownloader.metrics.save(args.metrics, fts.timings, fts.graph.get_report())
+        if args.prometheus:
+            ftsdownloader.metrics.save_prometheus(args.prometheus, fts.timings, fts.graph.get_report())
 
 
 if __name__ == '__main__':
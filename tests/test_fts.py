@@ -4,23 +4,45 @@
 Unit tests for fts.
 
 '''
+import json
 import logging
+import time
 from datetime import datetime
+from os import makedirs
 from os.path import join
 
 import pytest
 from hdx import hdx_locations
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.data.showcase import Showcase
 from hdx.data.vocabulary import Vocabulary
 from hdx.hdx_configuration import Configuration
 from hdx.location.country import Country
 from hdx.utilities.compare import assert_files_same
 from hdx.utilities.dateparse import parse_date
-from hdx.utilities.downloader import Download
+from hdx.utilities.downloader import Download, DownloadError
 from hdx.utilities.path import temp_dir
 
-from fts.download import FTSDownload
+from benchmarks.server import StandInServer
+from fts.archive import ResponseArchive
+from fts.cache import ResponseCache
+from fts.columnar import ColumnarExport
+from fts.costs import CountryCosts
+from fts.dag import StageGraph
+from fts.download import FTSDownload, FTSException
+from fts.flows import Flows
+from fts.flowstore import FlowStore
 from fts.locations import Locations
 from fts.main import FTS
+from fts.manifest import UploadManifest
+from fts.metrics import RunMetrics
+from fts.pipeline import UploadPipeline
+from fts.planindex import PlanIndex
+from fts.progress import CountryProgress
+from fts.ratelimiter import AdaptiveRateLimiter
+from fts.shards import assign_shards, load_artifact, parse_shard, save_artifact
+from fts.sorter import ExternalSorter
 
 logger = logging.getLogger(__name__)
 
@@ -166,3 +188,500 @@ class TestFTS:
                              {'name': 'covid-19', 'vocabulary_id': '4e61d464-4943-4e97-973a-84673c1aaa87'}]}
                 assert hxl_resource == resources[5]
                 assert ordered_resource_names == ['fts_requirements_funding_pse.csv', 'fts_requirements_funding_covid_pse.csv', 'fts_requirements_funding_cluster_pse.csv', 'fts_requirements_funding_globalcluster_pse.csv', 'fts_incoming_funding_pse.csv', 'fts_internal_funding_pse.csv', 'fts_outgoing_funding_pse.csv']
+
+    def test_download_batch(self, configuration):
+        with Download(user_agent='test') as downloader:
+            ftsdownloader = FTSDownload(configuration, downloader, testpath=True, rate_limit={'calls': 10, 'period': 1},
+                                        concurrency=3, downloader_factory=lambda: Download(user_agent='test'))
+            partial_urls = [f'2/country/{countryid}/summary/trends/2025' for countryid in (1, 114, 171)]
+            expected = [ftsdownloader.download(partial_url) for partial_url in partial_urls]
+            assert ftsdownloader.download_batch(partial_urls) == expected
+            assert len(ftsdownloader.worker_downloaders) != 0
+            ftsdownloader.close()
+            assert ftsdownloader.worker_downloaders == list()
+
+    def test_response_archive(self, configuration):
+        with temp_dir('FTS-TEST-ARCHIVE') as folder:
+            archive = ResponseArchive(join(folder, 'responses.db'))
+            for replay in (False, True):
+                with Download(user_agent='test') as downloader:
+                    ftsdownloader = FTSDownload(configuration, downloader, testpath=True, archive=archive,
+                                                replay=replay)
+                    locations = Locations(ftsdownloader)
+                    fts = FTS(ftsdownloader, locations, parse_date('2020-12-31'), configuration['notes'],
+                              start_year=2019)
+                    runfolder = join(folder, 'replay' if replay else 'record')
+                    makedirs(runfolder)
+                    dataset, _, _, _ = fts.generate_dataset_and_showcase(runfolder, locations.countries[0])
+            statuses = set()
+            for request in ftsdownloader.metrics.get_report()['requests']:
+                statuses.update(request['statuses'])
+            assert statuses == {'replay'}
+            assert archive.recorded > 0
+            assert archive.replayed >= archive.recorded
+            for resource in dataset.get_resources():
+                assert_files_same(join(folder, 'record', resource['name']), join(folder, 'replay', resource['name']))
+            with pytest.raises(FTSException):
+                ftsdownloader.download('1/fts/flow/custom-search?locationid=0&year=2020')
+            archive.close()
+
+    def test_adaptive_rate_limit(self):
+        with StandInServer(rate_limit={'calls': 3, 'period': 1}, retry_after=1) as server:
+            configuration = {'base_url': f'{server.url}/v', 'test_url': f'{server.url}/'}
+            with Download(user_agent='test') as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, retry_backoff=0.01,
+                                            rate_limit={'calls': 10, 'period': 1, 'max_calls': 20, 'min_calls': 1})
+                partial_url = '2/fts/flow/plan/overview/progress/2020'
+                results = ftsdownloader.download_batch([partial_url] * 8)
+                assert results[0]['plans']
+                assert all(result == results[0] for result in results)
+                totals = ftsdownloader.metrics.get_report()['totals']
+                assert totals['count'] == 8
+                assert totals['throttles'] > 0
+                assert totals['retries'] == totals['throttles']
+                assert ftsdownloader.ratelimiter.rate < 10
+                ftsdownloader.retries = 0
+                server.ratelimiter.tokens = 0
+                with pytest.raises(DownloadError):
+                    ftsdownloader.download(partial_url)
+                assert ftsdownloader.downloader.session.adapters['http://'].max_retries.total == 0
+        ratelimiter = AdaptiveRateLimiter(calls=4, period=1, max_calls=8)
+        limiters = [ratelimiter.share(2) for _ in range(2)]
+        assert limiters[0].rate == 2
+        limiters[0].throttle(retry_after=60)
+        limiters[1].refill()
+        assert limiters[1].rate == 1
+        assert limiters[1].shared_paused_until.value > time.monotonic() + 30
+
+    def test_response_cache(self, configuration):
+        ttls = [{'pattern': r'progress/(?P<year>\d{4})', 'closed_year': 1000, 'current_year': 10},
+                {'pattern': 'public-location', 'ttl': 100}]
+        with temp_dir('FTS-TEST-CACHE') as folder:
+            cache = ResponseCache(join(folder, 'cache.db'), ttls, today=parse_date('2020-12-31'))
+            assert cache.get_ttl('2/fts/flow/plan/overview/progress/2019') == 1000
+            assert cache.get_ttl('2/fts/flow/plan/overview/progress/2020') == 10
+            assert cache.get_ttl('1-public-location.json') == 100
+            assert cache.get_ttl('2/country/1/summary/trends/2025') is None
+            with Download(user_agent='test') as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True, cache=cache)
+                expected = ftsdownloader.download('1/public/location')
+                assert cache.misses == 1
+                assert ftsdownloader.download('1/public/location') == expected
+                assert cache.hits == 1
+                ftsdownloader.download('2/country/1/summary/trends/2025')
+                assert cache.get(ftsdownloader.get_cache_key(ftsdownloader.get_url('2-country-1-summary-trends-2025.json'))) is None
+                cache.max_size = 2
+                cache.set('other', '1-public-location.json', b'{}')
+                assert cache.get('other') is not None
+                assert cache.get(ftsdownloader.get_cache_key(ftsdownloader.get_url('1-public-location.json'))) is None
+                ftsdownloader.close()
+
+    def test_flow_store(self):
+        with temp_dir('FTS-TEST-FLOWSTORE') as folder:
+            flowstore = FlowStore(join(folder, 'flows.db'), 'updatedAfter', reconcile_days=7, today=parse_date('2020-12-31'))
+            assert flowstore.get_watermark('AFG', '2020') is None
+            flows = [{'id': 1, 'updatedAt': '2020-12-01T00:00:00.000Z'}, {'id': 2, 'updatedAt': '2020-12-02T00:00:00.000Z'}]
+            assert flowstore.store_flows('AFG', '2020', flows) == 2
+            watermark = flowstore.get_watermark('AFG', '2020')
+            assert watermark == '2020-12-02T00:00:00.000Z'
+            flows = [{'id': 4, 'updatedAt': '2020-12-29T00:00:00.000Z'}, {'id': 3, 'updatedAt': '2020-12-30T00:00:00.000Z'},
+                     {'id': 1, 'updatedAt': '2020-12-29T00:00:00.000Z', 'amountUSD': 5}, {'id': 2, 'updatedAt': '2020-12-02T00:00:00.000Z'}]
+            assert flowstore.store_flows('AFG', '2020', flows, watermark) == 3
+            # Merged flows come out in id order like a full harvest rather than the order they were stored in
+            assert list(flowstore.get_flows('AFG', '2020')) == [{'id': 1, 'updatedAt': '2020-12-29T00:00:00.000Z', 'amountUSD': 5},
+                                                               {'id': 2, 'updatedAt': '2020-12-02T00:00:00.000Z'},
+                                                               {'id': 3, 'updatedAt': '2020-12-30T00:00:00.000Z'},
+                                                               {'id': 4, 'updatedAt': '2020-12-29T00:00:00.000Z'}]
+            assert flowstore.get_watermark('AFG', '2020') == '2020-12-30T00:00:00.000Z'
+            flowstore.today = parse_date('2021-01-07')
+            assert flowstore.get_watermark('AFG', '2020') is None
+            flowstore.close()
+
+    def test_flow_store_parameter_ignored(self):
+        with temp_dir('FTS-TEST-FLOWSTORE-IGNORED') as folder:
+            flowstore = FlowStore(join(folder, 'flows.db'), 'updatedAfter', reconcile_days=7, today=parse_date('2020-12-31'))
+            flows = [{'id': 1, 'updatedAt': '2020-12-01T00:00:00.000Z'}, {'id': 2, 'updatedAt': '2020-12-02T00:00:00.000Z'},
+                     {'id': 3, 'updatedAt': '2020-12-03T00:00:00.000Z'}]
+            flowstore.store_flows('AFG', '2020', flows)
+            watermark = flowstore.get_watermark('AFG', '2020')
+            # Every flow comes back, with 3 updated and 2 deleted since the last harvest
+            flows = [{'id': 1, 'updatedAt': '2020-12-01T00:00:00.000Z'}, {'id': 3, 'updatedAt': '2020-12-30T00:00:00.000Z'},
+                     {'id': 4, 'updatedAt': '2020-12-30T00:00:00.000Z'}]
+            assert flowstore.store_flows('AFG', '2020', flows, watermark) == 3
+            assert list(flowstore.get_flows('AFG', '2020')) == flows
+            assert not flowstore.parameter_honoured
+            assert flowstore.get_watermark('AFG', '2020') is None
+            flowstore.close()
+            # The flow at the watermark comes before the one showing the watermark was ignored
+            flowstore = FlowStore(join(folder, 'flows.db'), 'updatedAfter', reconcile_days=7, today=parse_date('2020-12-31'))
+            watermark = flowstore.get_watermark('AFG', '2020')
+            flows = [{'id': 3, 'updatedAt': '2020-12-30T00:00:00.000Z'}, {'id': 1, 'updatedAt': '2020-12-01T00:00:00.000Z'},
+                     {'id': 4, 'updatedAt': '2020-12-30T00:00:00.000Z'}]
+            flowstore.store_flows('AFG', '2020', flows, watermark)
+            assert [flow['id'] for flow in flowstore.get_flows('AFG', '2020')] == [1, 3, 4]
+            assert not flowstore.parameter_honoured
+            flowstore.close()
+
+    def test_download_flows(self, configuration):
+        with Download(user_agent='test') as downloader:
+            ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+            url = ftsdownloader.get_url('1/fts/flow/custom-search?locationid=114&year=2020')
+            expected = list()
+            while url:
+                json = ftsdownloader.download(url=url, data=False)
+                expected.extend(json['data']['flows'])
+                url = json['meta'].get('nextLink')
+            flows = list(ftsdownloader.download_flows(ftsdownloader.get_url('1/fts/flow/custom-search?locationid=114&year=2020')))
+            assert flows == expected
+        with temp_dir('FTS-TEST-FLOWS-CACHE') as folder:
+            for pattern, misses in (('progress', 0), ('custom-search', 3)):
+                cache = ResponseCache(join(folder, f'{pattern}.db'), [{'pattern': pattern, 'ttl': 100}])
+                with Download(user_agent='test') as downloader:
+                    ftsdownloader = FTSDownload(configuration, downloader, testpath=True, cache=cache)
+                    url = ftsdownloader.get_url('1/fts/flow/custom-search?locationid=114&year=2020')
+                    assert list(ftsdownloader.download_flows(url)) == expected
+                    # Pages the cache has no rule for are streamed without looking them up
+                    assert cache.misses == misses
+                    ftsdownloader.close()
+
+    def test_external_sorter(self, configuration):
+        rows = [{'date': f'2020-0{i % 3 + 1}-01', 'id': i} for i in range(10)]
+        sorter = ExternalSorter(key=lambda k: k['date'], reverse=True, buffer_rows=3)
+        for row in rows:
+            sorter.add(row)
+        assert len(sorter.runs) == 3
+        assert list(sorter) == sorted(rows, key=lambda k: k['date'], reverse=True)
+        sorter.close()
+
+        with temp_dir('FTS-TEST-SORTER', delete_on_failure=False) as folder:
+            with Download(user_agent='test') as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                locations = Locations(ftsdownloader)
+                country = locations.countries[0]
+                flows = Flows(ftsdownloader, locations, dict())
+                flows.generate_resources(folder, Dataset({'name': 'test'}), '2020', country)
+                spillfolder = join(folder, 'spill')
+                makedirs(spillfolder)
+                flows = Flows(ftsdownloader, locations, dict(), sort_buffer_rows=10)
+                resources = flows.generate_resources(spillfolder, Dataset({'name': 'test'}), '2020', country)
+                assert [resource['name'] for resource in resources] == ['fts_incoming_funding_afg.csv', 'fts_internal_funding_afg.csv']
+                for resource in resources:
+                    assert_files_same(join(folder, resource['name']), join(spillfolder, resource['name']))
+
+    def test_country_progress(self):
+        countries = [{'iso3': 'AFG'}, {'iso3': 'SDN'}, {'iso3': 'PSE'}]
+        with temp_dir('FTS-TEST-PROGRESS') as folder:
+            progress = CountryProgress({'folder': folder})
+            assert progress.remaining(countries) == countries
+            progress.complete(countries[1])
+            progress = CountryProgress({'folder': folder})
+            assert progress.remaining(countries) == [{'iso3': 'AFG'}, {'iso3': 'PSE'}]
+
+    def test_upload_pipeline(self):
+        countries = [{'iso3': 'AFG'}, {'iso3': 'SDN'}, {'iso3': 'PSE'}, {'iso3': 'TUR'}]
+        uploaded = list()
+        failures = {'SDN': 1, 'PSE': 5}
+
+        def generate(info, country):
+            if country['iso3'] == 'TUR':
+                return None
+            return country['iso3'],
+
+        def upload(info, countryiso):
+            if failures.get(countryiso, 0) > 0:
+                failures[countryiso] -= 1
+                raise ValueError(countryiso)
+            uploaded.append(countryiso)
+
+        with temp_dir('FTS-TEST-PIPELINE') as folder:
+            info = {'folder': folder, 'batch': 'test'}
+            pipeline = UploadPipeline(info, upload, workers=2, maxsize=1, retries=1, backoff=0)
+            with pytest.raises(ValueError):
+                pipeline.run(countries, generate)
+            assert sorted(uploaded) == ['AFG', 'SDN']
+            assert info['progress'] == 'iso3=PSE'
+            pipeline = UploadPipeline(info, upload, retries=0, backoff=0)
+            failures['PSE'] = 0
+            pipeline.run(countries, generate)
+            assert uploaded[2:] == ['PSE']
+
+    def test_upload_manifest(self, configuration):
+        with temp_dir('FTS-TEST-MANIFEST') as folder:
+            dataset = Dataset({'name': 'fts-requirements-and-funding-data-for-afghanistan', 'title': 'AFG'})
+            showcase = Showcase({'name': 'fts-requirements-and-funding-data-for-afghanistan-showcase'})
+            for name in ('a.csv', 'b.csv'):
+                path = join(folder, name)
+                with open(path, 'w') as f:
+                    f.write(name)
+                resource = Resource({'name': name, 'description': name, 'format': 'csv'})
+                resource.set_file_to_upload(path)
+                dataset.add_update_resource(resource)
+            manifest = UploadManifest(join(folder, 'manifest.db'))
+            hashes = manifest.get_hashes(dataset, showcase)
+            assert manifest.compare(dataset['name'], hashes) == ('full', ['a.csv', 'b.csv'])
+            manifest.store(dataset['name'], hashes)
+            assert manifest.compare(dataset['name'], manifest.get_hashes(dataset, showcase)) == ('skipped', [])
+            with open(join(folder, 'b.csv'), 'w') as f:
+                f.write('changed')
+            assert manifest.compare(dataset['name'], manifest.get_hashes(dataset, showcase)) == ('partial', ['b.csv'])
+            dataset['title'] = 'Afghanistan'
+            assert manifest.compare(dataset['name'], manifest.get_hashes(dataset, showcase))[0] == 'full'
+            manifest.close()
+
+    def test_plan_index(self, configuration):
+        today = parse_date('2020-12-31')
+        with temp_dir('FTS-TEST-PLANINDEX') as folder:
+            structures = list()
+            for _ in range(2):
+                with Download(user_agent='test') as downloader:
+                    ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                    locations = Locations(ftsdownloader)
+                    planindex = PlanIndex(join(folder, 'plans.db'), today, refresh_years=0)
+                    fts = FTS(ftsdownloader, locations, today, configuration['notes'], start_year=2019,
+                              planindex=planindex)
+                    planindex.close()
+                    requests = ftsdownloader.metrics.get_report()['requests']
+                    structures.append((fts.plans_by_year_by_country, fts.planidcodemapping,
+                                       fts.planidswithonelocation, fts.globalplanids))
+            assert not any(request['endpoint'] == 'plan overview' for request in requests)
+            assert structures[1] == structures[0]
+            plan = structures[0][0]['AFG'][2020][0]
+            assert sorted(plan.keys()) == ['code', 'countries', 'endDate', 'id', 'name', 'planType', 'startDate',
+                                           'usageYears']
+            assert PlanIndex(join(folder, 'plans.db'), today).load(2020) is None
+
+    def test_plan_index_filtered(self, configuration):
+        today = parse_date('2020-12-31')
+        with temp_dir('FTS-TEST-PLANINDEX-FILTERED') as folder:
+            with Download(user_agent='test') as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                locations = Locations(ftsdownloader)
+                planindex = PlanIndex(join(folder, 'plans.db'), today, refresh_years=0)
+                fts = FTS(ftsdownloader, locations, today, configuration['notes'], start_year=2019, planindex=planindex)
+                planindex.close()
+            planids = set(fts.planidcodemapping)
+            # Only the plans stage is run filtered as the other stages' fixtures are for every country
+            state = dict(fts.get_state(), plans_by_year_by_country=dict(), planidcodemapping=dict(),
+                         planidswithonelocation=set(), globalplanids=set())
+            structures = list()
+            for indexed in (True, False):
+                with Download(user_agent='test') as downloader:
+                    ftsdownloader = FTSDownload(configuration, downloader, countryisos='AFG', testpath=True)
+                    planindex = PlanIndex(join(folder, 'plans.db'), today, refresh_years=0) if indexed else None
+                    fts = FTS(ftsdownloader, locations, today, configuration['notes'], planindex=planindex,
+                              state=state)
+                    fts.get_plans(start_year=2019)
+                    if planindex is not None:
+                        planindex.close()
+                        requests = ftsdownloader.metrics.get_report()['requests']
+                        assert not any(request['endpoint'] == 'plan overview' for request in requests)
+                    structures.append((fts.plans_by_year_by_country, fts.planidcodemapping,
+                                       fts.planidswithonelocation, fts.globalplanids))
+            # Plans from the snapshot of every plan are filtered the same as downloading them filtered
+            assert 'AFG' in structures[0][0]
+            assert set(structures[0][1]) < planids
+            assert structures[0] == structures[1]
+
+    def test_plans_usage_years(self, configuration):
+        today = parse_date('2020-12-31')
+        with Download(user_agent='test') as downloader:
+            ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+            locations = Locations(ftsdownloader)
+            state = FTS(ftsdownloader, locations, today, configuration['notes'], start_year=2019).get_state()
+        with temp_dir('FTS-TEST-USAGEYEARS') as folder:
+            filename = FTSDownload.get_testfile_path('2/fts/flow/plan/overview/progress/2020')
+            with open(join('tests', 'fixtures', 'input', filename)) as f:
+                plan = json.load(f)['data']['plans'][0]
+            # Plans covering several years are only listed under one of them
+            plans = list()
+            for planid, usage_years in ((9001, ['2019', '2020']), (9002, ['2019'])):
+                plans.append(dict(plan, id=planid, code=f'TEST{planid}',
+                                  usageYears=[{'year': year} for year in usage_years]))
+            for year, year_plans in ((2020, list()), (2019, plans)):
+                filename = FTSDownload.get_testfile_path(f'2/fts/flow/plan/overview/progress/{year}')
+                with open(join(folder, filename), 'w') as f:
+                    json.dump({'data': {'plans': year_plans}, 'status': 'ok'}, f)
+            with StandInServer(folder=folder) as server:
+                configuration = {'base_url': f'{server.url}/v', 'test_url': f'{server.url}/'}
+                with Download(user_agent='test') as downloader:
+                    ftsdownloader = FTSDownload(configuration, downloader, years='2020')
+                    fts = FTS(ftsdownloader, locations, today, dict(), state=state)
+                    fts.get_plans(start_year=2018)
+        assert 9001 in fts.planidcodemapping
+        assert 9002 not in fts.planidcodemapping
+
+    def test_country_costs(self):
+        with temp_dir('FTS-TEST-COSTS') as folder:
+            path = join(folder, 'costs.json')
+            costs = CountryCosts(path)
+            costs.update({'AFG': {'seconds': 4, 'csv_seconds': 1, 'requests': 10}, 'JOR': {'seconds': 2}})
+            costs.save()
+            costs = CountryCosts(path)
+            costs.update({'AFG': {'seconds': 8, 'requests': 20}})
+            assert costs.costs['AFG'] == {'seconds': 6, 'requests': 15}
+            countries = [{'iso3': iso3} for iso3 in ('AFG', 'JOR', 'SDN', 'SYR')]
+            seconds = costs.get_seconds(countries, {'AFG': 2, 'JOR': 2, 'SYR': 6})
+            assert seconds == {'AFG': 6, 'JOR': 2, 'SDN': 4, 'SYR': 12}
+            assert [country['iso3'] for country in costs.order(countries, {'AFG': 2, 'JOR': 2, 'SYR': 6})] == \
+                ['SYR', 'AFG', 'SDN', 'JOR']
+
+    def test_shards(self, configuration):
+        countries = [{'iso3': iso3} for iso3 in ('AFG', 'JOR', 'PSE', 'SDN', 'TUR')]
+        costs = {'AFG': 10, 'JOR': 2, 'PSE': 6, 'SDN': 5}
+        shards = assign_shards(countries, 2, costs)
+        assert [[country['iso3'] for country in shard] for shard in shards] == [['AFG', 'SDN'], ['JOR', 'PSE', 'TUR']]
+        assert parse_shard('1/2') == (1, 2)
+        with pytest.raises(ValueError):
+            parse_shard('2/2')
+        today = parse_date('2020-12-31')
+        with temp_dir('FTS-TEST-SHARDS') as folder:
+            path = join(folder, 'artifact.pkl')
+            with Download(user_agent='test') as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                locations = Locations(ftsdownloader)
+                fts = FTS(ftsdownloader, locations, today, configuration['notes'], start_year=2019)
+                save_artifact(path, today, locations, fts, costs)
+            assert load_artifact(path, parse_date('2021-01-01')) == (None, None, None)
+            locations, state, shardcosts = load_artifact(path, today)
+            assert shardcosts == costs
+            with Download(user_agent='test') as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                shardfts = FTS(ftsdownloader, locations, today, configuration['notes'], start_year=2019, state=state)
+                assert ftsdownloader.metrics.get_report()['totals']['count'] == 0
+                assert shardfts.get_state() == fts.get_state()
+                shardfts.generate_dataset_and_showcase(folder, locations.countries[0])
+            for filename in ('fts_requirements_funding_afg.csv', 'fts_requirements_funding_cluster_afg.csv',
+                             'fts_requirements_funding_covid_afg.csv'):
+                assert_files_same(join('tests', 'fixtures', filename), join(folder, filename))
+
+    def test_stage_graph(self, configuration):
+        graph = StageGraph()
+        graph.add('a', lambda: time.sleep(0.1))
+        graph.add('b', lambda: time.sleep(0.2), requires=('a',))
+        graph.add('c', lambda: 'c', requires=('a',))
+        graph.add('d', lambda: time.sleep(0.2))
+        with pytest.raises(ValueError):
+            graph.add('e', lambda: None, requires=('f',))
+        assert graph.run(workers=3)['c'] == 'c'
+        assert graph.times['b'][0] >= graph.times['a'][1]
+        assert graph.times['d'][0] < graph.times['a'][1]
+        path, seconds = graph.get_critical_path()
+        assert path == ['a', 'b']
+        assert seconds == pytest.approx(0.3, abs=0.1)
+        assert graph.get_report()['stages']['b']['requires'] == ['a']
+        today = parse_date('2020-12-31')
+        notes = configuration['notes']
+        # Served locally as the year wide fixtures for the global sweep are not in the repository that test_url points at
+        with temp_dir('FTS-TEST-GRAPH') as folder, StandInServer() as server:
+            configuration = {'base_url': f'{server.url}/v', 'test_url': f'{server.url}/'}
+            with Download(user_agent='test') as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True, concurrency=2,
+                                            downloader_factory=lambda: Download(user_agent='test'))
+                locations = Locations(ftsdownloader)
+                fts = FTS(ftsdownloader, locations, today, notes, start_year=2019, global_flows=True, stage_workers=4)
+                assert fts.graph.stages['flows'][1] == ()
+                assert fts.graph.get_critical_path()[0][0] in ('plans', 'flows')
+                stages = {request['stage'] for request in ftsdownloader.metrics.get_report()['requests']}
+                assert stages == {'plans', 'requirements_funding', 'covid', 'clusters', 'trends', 'flows', 'other'}
+                fts.generate_dataset_and_showcase(folder, locations.countries[0])
+                fts.flows.partitions.close()
+                ftsdownloader.close()
+            for filename in ('fts_requirements_funding_afg.csv', 'fts_requirements_funding_cluster_afg.csv',
+                             'fts_requirements_funding_covid_afg.csv'):
+                assert_files_same(join('tests', 'fixtures', filename), join(folder, filename))
+
+    def test_upload_manifest_run_date(self, configuration):
+        with temp_dir('FTS-TEST-MANIFEST-DATE') as folder:
+            manifest = UploadManifest(join(folder, 'manifest.db'))
+            for day in ('2020-12-30', '2020-12-31'):
+                with Download(user_agent='test') as downloader:
+                    ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                    locations = Locations(ftsdownloader)
+                    fts = FTS(ftsdownloader, locations, parse_date(day), configuration['notes'], start_year=2019)
+                    dataset, showcase, _, _ = fts.generate_dataset_and_showcase(folder, locations.countries[0])
+                hashes = manifest.get_hashes(dataset, showcase)
+                if day == '2020-12-30':
+                    manifest.store(dataset['name'], hashes)
+            assert manifest.compare(dataset['name'], hashes) == ('skipped', [])
+            manifest.close()
+
+    def test_run_metrics(self, configuration):
+        with Download(user_agent='test') as downloader:
+            ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+            metrics = ftsdownloader.metrics
+            with metrics.staged('locations'):
+                Locations(ftsdownloader)
+            with metrics.staged('flows'):
+                flows = list(ftsdownloader.download_flows(ftsdownloader.get_url('1/fts/flow/custom-search?locationid=114&year=2020')))
+            with metrics.timed_country('AFG'):
+                with metrics.timed_csv():
+                    pass
+            report = metrics.get_report({'plans': 1.5})
+            requests = {(x['stage'], x['endpoint']): x for x in report['requests']}
+            assert sorted(requests.keys()) == [('flows', 'flows page'), ('locations', 'location')]
+            assert requests['flows', 'flows page']['count'] == 3
+            assert requests['flows', 'flows page']['bytes'] > 0
+            assert report['totals']['count'] == 4
+            assert report['stages'] == {'plans': 1.5}
+            assert list(report['countries'].keys()) == ['AFG']
+            assert RunMetrics.get_endpoint('1/fts/flow/custom-search?planid=943&groupby=globalcluster') == 'custom-search groupby globalcluster'
+            assert RunMetrics.get_endpoint('2/fts/flow/plan/overview/progress/2020') == 'plan overview'
+            prometheus = metrics.get_prometheus()
+            assert 'fts_requests_total{stage="flows",endpoint="flows page",status="200"} 3' in prometheus
+            assert len(flows) == 478
+
+    def test_columnar_export(self, configuration):
+        pyarrow = pytest.importorskip('pyarrow')
+        import pyarrow.dataset
+        with temp_dir('FTS-TEST-COLUMNAR') as folder:
+            with Download(user_agent='test') as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                locations = Locations(ftsdownloader)
+                export = ColumnarExport(join(folder, 'parquet'))
+                fts = FTS(ftsdownloader, locations, parse_date('2020-12-31'), configuration['notes'], start_year=2019,
+                          export=export)
+                fts.generate_dataset_and_showcase(folder, locations.countries[0])
+                flows = pyarrow.dataset.dataset(join(folder, 'parquet', 'flows'), partitioning='hive').to_table()
+                assert flows.num_rows == 484
+                assert flows.schema.field('destLocations').type == pyarrow.list_(pyarrow.string())
+                assert flows.schema.field('amountUSD').type == pyarrow.float64()
+                assert flows.schema.field('date').type == pyarrow.date32()
+                assert pyarrow.types.is_dictionary(flows.schema.field('srcOrganization').type)
+                assert set(flows.column('countryCode').to_pylist()) == {'AFG'}
+                row = flows.slice(0, 1).to_pylist()[0]
+                assert row['destLocations'] == ['AFG']
+                reqfund = pyarrow.dataset.dataset(join(folder, 'parquet', 'requirements_funding'),
+                                                  partitioning='hive').to_table()
+                assert reqfund.num_rows == 3
+                assert reqfund.schema.field('requirements').type == pyarrow.float64()
+                with open(join('tests', 'fixtures', 'input', 'custom-search-locationid-1-year-2020.json')) as f:
+                    flows = json.load(f)['data']['flows']
+                # A flow to two plans
+                flow = next(flow for flow in flows if any(obj['type'] == 'Plan' for obj in flow['destinationObjects']))
+                plan = next(obj for obj in flow['destinationObjects'] if obj['type'] == 'Plan')
+                flow['destinationObjects'].append(dict(plan, id=str(int(plan['id']) + 1), name='Another plan'))
+                row = fts.flows.flatten_flow(flow)
+                assert row['destPlanId'] == 'Multiple'
+                export.add('flows', 'PSE', 2020, row)
+                export.write('flows', 'PSE')
+                flows = pyarrow.dataset.dataset(join(folder, 'parquet', 'flows', 'countryCode=PSE'),
+                                                partitioning='hive').to_table()
+                row = flows.to_pylist()[0]
+                assert row['destPlanId'] is None
+                assert row['destPlan'] == 'Multiple'
+
+    def test_sweep_flows(self, configuration):
+        # Served locally as the year wide fixtures are not in the repository that test_url points at
+        with StandInServer() as server:
+            configuration = {'base_url': f'{server.url}/v', 'test_url': f'{server.url}/'}
+            with Download(user_agent='test') as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader)
+                locations = Locations(ftsdownloader)
+                flows = Flows(ftsdownloader, locations, dict())
+                flows.sweep_flows('2020')
+                assert flows.partitions_year == '2020'
+                for country in locations.countries:
+                    expected = {flow['id']: flow for flow in flows.get_flows(country, '2020')}
+                    actual = {flow['id']: flow for flow in flows.partitions.get(country['iso3'])}
+                    assert actual == expected
+                flows.partitions.close()